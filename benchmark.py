@@ -0,0 +1,334 @@
+'''Rendering (and board storage) benchmarks. Run with `python benchmark.py [--json results.json]`,
+and diff the json between releases'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import chess
+import PIL
+from PIL import Image
+
+import drawing
+import rendercache
+import svgdrawing
+
+# Fixed, so that results from different releases can be compared. Every one is rendered from both sides
+CORPUS = [
+	('opening', 'start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'),
+	('opening', 'italian', 'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R'),
+	('opening', 'sicilian najdorf', 'rnbqkb1r/1p2pppp/p2p1n2/8/3NP3/2N5/PPP2PPP/R1BQKB1R'),
+	('middlegame', 'queens gambit declined', 'r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1'),
+	('middlegame', 'kings indian', 'r1bq1rk1/pp1nppbp/2pp1np1/8/2PPP3/2N2N2/PP2BPPP/R1BQ1RK1'),
+	('middlegame', 'open', 'r4rk1/1bq1bppp/p2ppn2/1p6/3NPP2/P1N1B3/1PP1B1PP/R2Q1R1K'),
+	('endgame', 'rook', '8/5pk1/6p1/8/3R4/6P1/5PK1/3r4'),
+	('endgame', 'king and pawn', '8/8/4k3/8/4P3/4K3/8/8'),
+	('endgame', 'bishops', '8/2b2k2/1p4p1/p7/P1B5/1P3K2/6P1/8'),
+	('chess960', 'position 0', 'bbqnnrkr/pppppppp/8/8/8/8/PPPPPPPP/BBQNNRKR'),
+	('chess960', 'position 100', 'qbbnrnkr/pppppppp/8/8/8/8/PPPPPPPP/QBBNRNKR'),
+	('chess960', 'position 959', 'rkrnnqbb/pppppppp/8/8/8/8/PPPPPPPP/RKRNNQBB'),
+]
+POSITIONS = [placement for _, _, placement in CORPUS]
+
+def game_placements(sans):
+	board = chess.Board()
+	placements = [board.board_fen()]
+	for san in sans:
+		board.push_san(san)
+		placements.append(board.board_fen())
+	return placements
+
+# Every position of a game (the Breyer Ruy Lopez), for drawing positions one after another
+GAME = game_placements('e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O h3 Nb8 d4 Nbd7'.split())
+PERSPECTIVES = [True, False]
+
+def legacy_render(placement, iswhite):
+	'''drawing.create_board_image as it used to be: every image read from disk, every piece alpha blended'''
+	rows = drawing.oriented_rows(placement, iswhite)
+	with Image.open(drawing.BOARD_IMAGES[iswhite]).copy() as board_image:
+		for i, row in enumerate(rows):
+			for j, piece in enumerate(row):
+				if piece in drawing.PIECE_IMAGES:
+					piece_image = Image.open(drawing.PIECE_IMAGES[piece])
+					board_image.paste(piece_image, (drawing.BORDER + 64*j, drawing.BORDER + 64*i), piece_image)
+		return board_image
+
+def alpha_render(renderer, placement, iswhite):
+	'''Sprites kept in memory, but still alpha blended onto the board one at a time'''
+	board_image = renderer.boards[iswhite].copy()
+	for i, row in enumerate(drawing.oriented_rows(placement, iswhite)):
+		for j, piece in enumerate(row):
+			sprite = renderer.sprites.get(piece)
+			if sprite is not None:
+				board_image.paste(sprite, (drawing.BORDER + 64*j, drawing.BORDER + 64*i), sprite)
+	return board_image
+
+def ms_per_frame(render, positions=POSITIONS, repeat=5):
+	frames = 0
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for placement in positions:
+			for iswhite in PERSPECTIVES:
+				render(placement, iswhite)
+				frames += 1
+	return (time.perf_counter() - start) * 1000 / frames
+
+def kb_per_frame(render, positions=POSITIONS):
+	'''Peak memory traced by tracemalloc while drawing a frame, averaged over the corpus.
+	That covers python objects and numpy arrays, but not the pixel buffers PIL mallocs itself'''
+	peaks = []
+	for placement in positions:
+		for iswhite in PERSPECTIVES:
+			tracemalloc.start()
+			render(placement, iswhite)
+			peaks.append(tracemalloc.get_traced_memory()[1])
+			tracemalloc.stop()
+	return sum(peaks) / len(peaks) / 1024
+
+def measure(render, repeat=5):
+	# Once untimed, so that loading sprites and the like doesn't count
+	render(POSITIONS[0], True)
+	return {'ms_per_frame': ms_per_frame(render, repeat=repeat), 'kb_per_frame': kb_per_frame(render)}
+
+def bench_renderers():
+	'''Drawing a frame (no encoding) every way we know how'''
+	renderer = drawing.BoardRenderer()
+	results = {
+		'legacy (disk + alpha paste)': measure(legacy_render),
+		'in-memory sprites (alpha paste)': measure(lambda placement, iswhite: alpha_render(renderer, placement, iswhite)),
+		'tiles (opaque paste)': measure(renderer.render_full),
+		'tiles, palette': measure(lambda placement, iswhite: renderer.render_full(placement, iswhite, True)),
+	}
+	# Consecutive positions of a game, each repainted from the last, as for replays and /explore
+	for palette in [False, True]:
+		frames = 2 * len(GAME) * 5
+		start = time.perf_counter()
+		for _ in range(5):
+			for iswhite in PERSPECTIVES:
+				# Each frame is let go of as soon as the next one is drawn, as when they're encoded one by one
+				for _ in renderer.render_sequence(GAME, iswhite, palette):
+					pass
+		results['sequence (repaint)' + (', palette' if palette else '')] = {'ms_per_frame': (time.perf_counter() - start) * 1000 / frames}
+
+	# What the rest of the code still calls: render and write a file
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, 'board.png')
+		results['drawing.create_board_image'] = measure(lambda placement, iswhite: drawing.create_board_image(placement, iswhite, filename))
+	return results
+
+def bench_formats(repeat=3):
+	'''Encoded size and render + encode time for each output format'''
+	renders = {image_format: (lambda placement, iswhite, image_format=image_format: drawing.render_board(placement, iswhite, image_format))
+		for image_format in drawing.supported_formats()}
+	renders['svg'] = svgdrawing.render_board
+	results = {}
+	for image_format, render in renders.items():
+		sizes = [len(render(placement, iswhite)) for placement in POSITIONS for iswhite in PERSPECTIVES]
+		results[image_format] = dict(measure(render, repeat), bytes_per_frame=sum(sizes) / len(sizes))
+	gzipped = [len(svgdrawing.compress(svgdrawing.render_board(placement, iswhite))) for placement in POSITIONS for iswhite in PERSPECTIVES]
+	results['svg']['gzipped_bytes_per_frame'] = sum(gzipped) / len(gzipped)
+	return results
+
+def bench_cache(image_format='png8'):
+	'''The same corpus through the render cache twice: once cold, once all hits'''
+	cache = rendercache.RenderCache(memory_budget=64 * 2**20)
+	results = {}
+	for run in ['cold', 'warm']:
+		start = time.perf_counter()
+		for placement in POSITIONS:
+			for iswhite in PERSPECTIVES:
+				key = rendercache.board_key(placement, iswhite, image_format)
+				cache.get_or_render(key, lambda: drawing.render_board(placement, iswhite, image_format))
+		results[run + '_ms_per_frame'] = (time.perf_counter() - start) * 1000 / (2 * len(POSITIONS))
+	results['stats'] = cache.stats()
+	return results
+
+def bench_route():
+	'''GET /board/<fen> through the flask test client, cold and then cached.
+	Importing the bot needs its environment (tokens, database), so this is skipped without it'''
+	try:
+		import fbchessbot
+	except Exception as e:
+		return {'skipped': repr(e)}
+
+	client = fbchessbot.app.test_client()
+	urls = [f'/board/{placement.replace("/", "-")}?perspective={"w" if iswhite else "b"}&format=png8'
+		for placement in POSITIONS for iswhite in PERSPECTIVES]
+	results = {}
+	for run in ['cold', 'warm']:
+		start = time.perf_counter()
+		for url in urls:
+			response = client.get(url)
+			assert response.status_code == 200, (url, response.status)
+		results[run + '_ms_per_request'] = (time.perf_counter() - start) * 1000 / len(urls)
+
+	# And clients that already have the image
+	etags = [client.get(url).headers['ETag'] for url in urls]
+	start = time.perf_counter()
+	for url, etag in zip(urls, etags):
+		client.get(url, headers={'If-None-Match': etag})
+	results['not_modified_ms_per_request'] = (time.perf_counter() - start) * 1000 / len(urls)
+	results['stats'] = fbchessbot.board_cache.stats()
+	return results
+
+def random_game(plies, seed, fen=None):
+	'''Same moves every time for a given seed (and python-chess)'''
+	import dbactions
+	rng = random.Random(seed)
+	board = dbactions.ChessBoard(fen)
+	while len(board.move_stack) < plies and not board.is_game_over():
+		board.push(rng.choice(sorted(board.legal_moves, key=lambda move: move.uci())))
+	return board
+
+def bench_board_encoding(repeat=3):
+	'''Encoding and decoding stored boards in each format, for long games.
+	Needs dbactions to import (psycopg2, DATABASE_URL) but not an actual database'''
+	try:
+		import dbactions
+	except Exception as e:
+		return {'skipped': repr(e)}
+
+	games = {
+		'100 plies': random_game(100, 1),
+		'200 plies': random_game(200, 2),
+		'400 plies': random_game(400, 3),
+		'chess960, 200 plies': random_game(200, 4, 'qbbnrnkr/pppppppp/8/8/8/8/PPPPPPPP/QBBNRNKR w KQkq - 0 1'),
+	}
+	results = {}
+	for name, board in games.items():
+		result = results[name] = {'plies': len(board.move_stack)}
+		for version in [1, 2]:
+			start = time.perf_counter()
+			for _ in range(repeat):
+				data = board.to_byte_string(version)
+			encode_ms = (time.perf_counter() - start) * 1000 / repeat
+			start = time.perf_counter()
+			for _ in range(repeat):
+				dbactions.ChessBoard.from_byte_string(data)
+			decode_ms = (time.perf_counter() - start) * 1000 / repeat
+			result[f'v{version}'] = {'bytes': len(data), 'encode_ms': encode_ms, 'decode_ms': decode_ms}
+	return results
+
+# Players that only exist while bench_webhook_queries runs
+BENCH_PLAYERS = (9000000000000001, 9000000000000002)
+
+def bench_webhook_queries(webhooks=200):
+	'''The statements a typical move webhook runs, with and without prepared statements.
+	Needs a real database, and cleans up after itself'''
+	try:
+		import constants
+		import dbactions
+		db = dbactions.DB()
+		with db.cursor() as cur:
+			cur.execute('SELECT 1')
+	except Exception as e:
+		return {'skipped': repr(e)}
+
+	playerid, opponentid = BENCH_PLAYERS
+	def cleanup():
+		with db.cursor() as cur:
+			cur.execute('DELETE FROM cb.message_log WHERE senderid = ANY(%s) OR recipientid = ANY(%s)', [list(BENCH_PLAYERS)] * 2)
+			cur.execute('DELETE FROM games WHERE whiteplayer = ANY(%s)', [list(BENCH_PLAYERS)])
+			cur.execute('UPDATE player SET opponent_context = NULL WHERE id = ANY(%s)', [list(BENCH_PLAYERS)])
+			cur.execute('DELETE FROM player WHERE id = ANY(%s)', [list(BENCH_PLAYERS)])
+
+	def webhook():
+		db.log_message('e4', constants.MessageType.PLAYER_MESSAGE, senderid=playerid)
+		db.user_is_registered(playerid)
+		player, opponent, game = db.get_context(playerid)
+		db.is_blocked(playerid, opponentid)
+		db.log_message('Opponent played e4', constants.MessageType.CHESSBOT_TEXT, recipientid=opponentid)
+
+	cleanup()
+	try:
+		db.set_nickname(playerid, 'benchwhite')
+		db.set_nickname(opponentid, 'benchblack')
+		db.set_opponent_context(playerid, opponentid)
+		db.create_new_game(playerid, opponentid)
+
+		results = {'webhooks': webhooks}
+		for prepared in [False, True]:
+			db.prepare_statements = prepared
+			webhook()				# Connect (and prepare) before timing
+			start = time.perf_counter()
+			for _ in range(webhooks):
+				webhook()
+			results['prepared' if prepared else 'unprepared'] = {'ms_per_webhook': (time.perf_counter() - start) * 1000 / webhooks}
+	finally:
+		cleanup()
+	return results
+
+def run():
+	return {
+		'meta': {
+			'date': datetime.datetime.utcnow().isoformat(),
+			'python': platform.python_version(),
+			'pillow': PIL.__version__,
+			'corpus': [{'phase': phase, 'name': name, 'placement': placement} for phase, name, placement in CORPUS],
+		},
+		'renderers': bench_renderers(),
+		'formats': bench_formats(),
+		'cache': bench_cache(),
+		'route': bench_route(),
+		'board_encoding': bench_board_encoding(),
+		'webhook_queries': bench_webhook_queries(),
+	}
+
+def print_results(results):
+	print('Drawing one frame')
+	for name, result in results['renderers'].items():
+		memory = f'{result["kb_per_frame"]:8.1f} KB/frame' if 'kb_per_frame' in result else ''
+		print(f'  {name:<32}{result["ms_per_frame"]:8.3f} ms/frame{memory}')
+
+	print('Rendering and encoding one frame')
+	for name, result in results['formats'].items():
+		print(f'  {name:<8}{result["bytes_per_frame"]:10.0f} bytes/frame{result["ms_per_frame"]:8.3f} ms/frame{result["kb_per_frame"]:8.1f} KB/frame')
+
+	cache = results['cache']
+	print('Render cache')
+	print(f'  cold {cache["cold_ms_per_frame"]:.3f} ms/frame, warm {cache["warm_ms_per_frame"]:.3f} ms/frame')
+
+	route = results['route']
+	print('GET /board')
+	if 'skipped' in route:
+		print('  skipped:', route['skipped'])
+	else:
+		print(f'  cold {route["cold_ms_per_request"]:.3f} ms, warm {route["warm_ms_per_request"]:.3f} ms,'
+			f' 304 {route["not_modified_ms_per_request"]:.3f} ms per request')
+
+	encoding = results['board_encoding']
+	print('Stored board encoding')
+	if 'skipped' in encoding:
+		print('  skipped:', encoding['skipped'])
+	else:
+		for name, result in encoding.items():
+			for version in ['v1', 'v2']:
+				timing = result[version]
+				print(f'  {name:<22}{version}{timing["bytes"]:6d} bytes{timing["encode_ms"]:9.2f} ms encode{timing["decode_ms"]:9.2f} ms decode')
+
+	queries = results['webhook_queries']
+	print('Database statements for one webhook')
+	if 'skipped' in queries:
+		print('  skipped:', queries['skipped'])
+	else:
+		for name in ['unprepared', 'prepared']:
+			print(f'  {name:<12}{queries[name]["ms_per_webhook"]:8.3f} ms/webhook')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--json', help='also write the results to this file')
+	args = parser.parse_args()
+
+	results = run()
+	print_results(results)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+		print('Wrote', args.json, file=sys.stderr)
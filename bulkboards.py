@@ -0,0 +1,148 @@
+'''Decodes (or re-encodes) every stored board across a pool of processes. For format upgrades, and
+anything else that needs to look at all the games:
+
+	python bulkboards.py reencode [--version 2] [--processes 4] [--batch 500] [--restart]
+
+Rows are streamed from a server side cursor and written back a batch at a time. The last id written
+is kept in a state file, so an interrupted run carries on from there'''
+import argparse
+import functools
+import multiprocessing
+import os
+import time
+
+import chess
+import psycopg2
+import psycopg2.extras
+
+import dbactions
+
+BATCH_SIZE = 500
+
+def connect():
+	# Batches are committed as they're written, and the reading side needs a transaction for its cursor
+	return dbactions.connect(autocommit=False)
+
+def count_games(conn, after_id=0):
+	with conn.cursor() as cur:
+		cur.execute('SELECT COUNT(*) FROM games WHERE id > %s', [after_id])
+		return cur.fetchone()[0]
+
+def read_boards(conn, after_id=0, batch_size=BATCH_SIZE):
+	'''Lists of (id, raw board) in id order, without ever holding more than a batch in memory'''
+	with conn.cursor(name='bulkboards') as cur:
+		cur.itersize = batch_size
+		cur.execute('SELECT id, board FROM games WHERE id > %s ORDER BY id', [after_id])
+		while True:
+			rows = cur.fetchmany(batch_size)
+			if not rows:
+				break
+			yield [(id, bytes(board)) for id, board in rows]
+
+def _apply(func, row):
+	id, raw_board = row
+	return id, raw_board, func(dbactions.ChessBoard.from_byte_string(raw_board))
+
+def map_boards(func, after_id=0, processes=None, batch_size=BATCH_SIZE):
+	'''Yields a list of (id, raw board, func(board)) for each batch of games, in id order.
+	func gets the decoded ChessBoard in a worker process, so it has to be picklable: a module
+	level function, or a functools.partial of one. The next batch is decoded while this one is used'''
+	conn = connect()
+	try:
+		with multiprocessing.Pool(processes) as pool:
+			pending = None
+			for rows in read_boards(conn, after_id, batch_size):
+				batch = pool.map_async(functools.partial(_apply, func), rows)
+				if pending is not None:
+					yield pending.get()
+				pending = batch
+			if pending is not None:
+				yield pending.get()
+	finally:
+		conn.close()
+
+def reencoded(board, version=dbactions.BOARD_FORMAT_VERSION):
+	'''Everything that's stored about a game's board'''
+	return board.to_byte_string(version), board.turn == chess.WHITE, board.fen(), board.position_hashes(), board.checkpoints()
+
+def write_reencoded(conn, results):
+	'''Writes back a batch from map_boards(reencoded). Games that were moved in since they were read
+	are left alone (the bot saves those itself). Returns how many were written'''
+	with conn.cursor() as cur:
+		rows = [(id, psycopg2.Binary(raw_board), psycopg2.Binary(board), white_to_play, fen, psycopg2.Binary(position_hashes))
+			for id, raw_board, (board, white_to_play, fen, position_hashes, _) in results]
+		psycopg2.extras.execute_values(cur, '''
+			UPDATE games SET board = v.board, white_to_play = v.white_to_play, current_fen = v.current_fen,
+				position_hashes = v.position_hashes
+			FROM (VALUES %s) AS v (id, old_board, board, white_to_play, current_fen, position_hashes)
+			WHERE games.id = v.id AND games.board = v.old_board
+			RETURNING games.id
+			''', rows, page_size=len(rows))
+		written = {row[0] for row in cur.fetchall()}
+
+		if written:
+			cur.execute('DELETE FROM cb.game_checkpoint WHERE gameid = ANY(%s)', [list(written)])
+			checkpoints = [(id, ply, fen)
+				for id, _, (_, _, _, _, game_checkpoints) in results if id in written
+				for ply, fen in game_checkpoints]
+			if checkpoints:
+				psycopg2.extras.execute_values(cur, '''
+					INSERT INTO cb.game_checkpoint (gameid, ply, fen) VALUES %s
+					''', checkpoints)
+	conn.commit()
+	return len(written)
+
+def load_state(state_file):
+	try:
+		with open(state_file) as f:
+			return int(f.read().strip() or 0)
+	except FileNotFoundError:
+		return 0
+
+def save_state(state_file, last_id):
+	# Written whole and then moved into place, so a kill never leaves half a number behind
+	with open(state_file + '.tmp', 'w') as f:
+		f.write(str(last_id))
+	os.replace(state_file + '.tmp', state_file)
+
+def reencode_boards(version=dbactions.BOARD_FORMAT_VERSION, processes=None, batch_size=BATCH_SIZE,
+		state_file='', restart=False, report=print):
+	'''Rewrites every game's board in the given format, along with its turn, current fen, position hashes and checkpoints.
+	state_file defaults to one per version; pass None to neither resume nor record progress'''
+	if state_file == '':
+		state_file = f'reencode-v{version}.progress'
+	after_id = 0 if restart or state_file is None else load_state(state_file)
+
+	conn = connect()
+	try:
+		total = count_games(conn, after_id)
+		if after_id:
+			report(f'Resuming after game {after_id}')
+		start = time.perf_counter()
+		done = written = 0
+		for results in map_boards(functools.partial(reencoded, version=version), after_id, processes, batch_size):
+			written += write_reencoded(conn, results)
+			done += len(results)
+			last_id = results[-1][0]
+			if state_file is not None:
+				save_state(state_file, last_id)
+			rate = done / (time.perf_counter() - start)
+			report(f'{done}/{total} games ({rate:.0f}/s), up to game {last_id}')
+	finally:
+		conn.close()
+
+	if done - written:
+		report(f'{done - written} games changed while running and were left as they were')
+	return done, written
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('command', choices=['reencode'])
+	parser.add_argument('--version', type=int, default=dbactions.BOARD_FORMAT_VERSION)
+	parser.add_argument('--processes', type=int, default=None, help='defaults to one per cpu')
+	parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+	parser.add_argument('--restart', action='store_true', help='ignore the state file and start from the first game')
+	args = parser.parse_args()
+
+	reencode_boards(args.version, args.processes, args.batch, restart=args.restart)
@@ -0,0 +1,105 @@
+'''Checks that the bot's most common lookups use the indexes made for them (dbtools.migration22).
+Seeds a large made-up dataset, EXPLAINs each lookup, and then rolls it all back:
+
+	python checkindexes.py [--players 20000] [--games 200000]
+
+Exits non-zero if any lookup doesn't use its index'''
+import argparse
+import sys
+
+import dbactions
+
+# Seeded players get ids well away from any real (facebook) ones
+SEED_BASE = 10**15
+
+def seed(cur, players, games):
+	cur.execute('''
+		INSERT INTO player (id, nickname)
+		SELECT %s + i, 'Seed' || i FROM generate_series(1, %s) i
+		''', [SEED_BASE, players])
+	# Each player plays a handful of others, except for the first, who is in a tenth of all games
+	# (like the bot's author). One game in fifty is still going
+	cur.execute('''
+		INSERT INTO games (whiteplayer, blackplayer, active)
+		SELECT CASE WHEN i %% 10 = 0 THEN %(base)s + 1 ELSE %(base)s + 1 + i %% %(players)s END,
+			%(base)s + 1 + (i * 7 + 1) %% %(players)s, i %% 50 = 0
+		FROM generate_series(1, %(games)s) i
+		''', {'base': SEED_BASE, 'players': players, 'games': games})
+	cur.execute('''
+		INSERT INTO cb.player_relationship (initiating_playerid, receiving_playerid, relationship_state)
+		SELECT %(base)s + 1 + i %% %(players)s, %(base)s + 1 + (i * 13 + 5) %% %(players)s, 'FRIENDS'
+		FROM generate_series(1, %(players)s) i
+		ON CONFLICT DO NOTHING
+		''', {'base': SEED_BASE, 'players': players})
+	cur.execute('UPDATE player SET opponent_context = %s WHERE id = %s', [SEED_BASE + 2, SEED_BASE + 1])
+	cur.execute('ANALYZE player')
+	cur.execute('ANALYZE games')
+	cur.execute('ANALYZE cb.player_relationship')
+
+# (what, query, args, indexes it should use). Where more than one set of indexes would do, any of
+# them passes. The queries inside plpgsql functions can't be EXPLAINed through the function,
+# so those are copies of the parts that matter
+CHECKS = [
+	('cb.get_playerid',
+		'SELECT id FROM player WHERE lower(nickname) = lower(%s)',
+		['seed123'], [{'ix_player_lower_nickname'}]),
+	('cb.get_context',
+		'''
+		SELECT g.id
+		FROM player p
+		LEFT JOIN player o ON p.opponent_context = o.id
+		LEFT JOIN games g ON (
+				(g.whiteplayer = p.id AND g.blackplayer = o.id)
+				OR
+				(g.blackplayer = p.id AND g.whiteplayer = o.id)
+			)
+			AND (g.active = TRUE)
+		WHERE p.id = %s
+		''',
+		[SEED_BASE + 1], [{'ix_games_active_players'}, {'ix_games_whiteplayer_id', 'ix_games_blackplayer_id'}]),
+	# For the first player, a backwards scan of the primary key finds their latest game soonest,
+	# so this checks an ordinary one
+	('DB.get_most_recent_gameid',
+		dbactions.STATEMENTS['most_recent_gameid'],
+		[SEED_BASE + 3] * 2, [{'ix_games_whiteplayer_id', 'ix_games_blackplayer_id'}]),
+	('cb.blocked',
+		'SELECT * FROM cb.player_relationship WHERE initiating_playerid = %s AND receiving_playerid = %s',
+		[SEED_BASE + 1, SEED_BASE + 2], [{'ux_initiating_receiving'}]),
+]
+
+def plan_indexes(plan):
+	'''Every index a plan (and its subplans) reads'''
+	out = set()
+	if 'Index Name' in plan:
+		out.add(plan['Index Name'].lower())
+	for subplan in plan.get('Plans', []):
+		out |= plan_indexes(subplan)
+	return out
+
+def check(players=20000, games=200000, report=print):
+	'''Returns the names of the checks that failed'''
+	conn = dbactions.connect(autocommit=False)
+	failed = []
+	try:
+		with conn.cursor() as cur:
+			seed(cur, players, games)
+			for name, query, args, alternatives in CHECKS:
+				cur.execute('EXPLAIN (FORMAT JSON) ' + query, args)
+				used = plan_indexes(cur.fetchone()[0][0]['Plan'])
+				ok = any(indexes <= used for indexes in alternatives)
+				if not ok:
+					failed.append(name)
+				report(f'{"ok" if ok else "FAIL":<6}{name:<34}uses {", ".join(sorted(used)) or "no indexes"}')
+	finally:
+		conn.rollback()
+		conn.close()
+	return failed
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--players', type=int, default=20000)
+	parser.add_argument('--games', type=int, default=200000)
+	args = parser.parse_args()
+
+	sys.exit(1 if check(args.players, args.games) else 0)
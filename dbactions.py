@@ -1,14 +1,21 @@
 import collections
+import contextlib
 import datetime
 import os
+import itertools
 import pickle
+import re
+import threading
 from urllib.parse import urlparse
 
 import chess
+import chess.polyglot
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 
 import constants
+import dbpool
 
 try:
 	import env
@@ -18,6 +25,85 @@ except ModuleNotFoundError:
 
 DATABASE_URL = os.environ['DATABASE_URL']
 
+# Connections are opened as needed up to the max, and checked if they've sat idle for a while
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', 30))
+
+# The statements (nearly) every webhook runs. Each connection prepares one the first time it runs it,
+# so postgres parses and plans it once per connection instead of on every call
+PREPARE_STATEMENTS = os.environ.get('DB_PREPARE_STATEMENTS', '1') == '1'
+STATEMENTS = {
+	'get_context': '''
+		SELECT playerid, player_nickname, player_opponentid, player_active,
+			opponentid, opponent_nickname, opponent_opponentid, opponent_active,
+			gameid, board, active, whiteplayer, blackplayer, undo, outcome, last_moved_at_utc, white_to_play,
+			checkpoint_ply, checkpoint_fen, position_hashes
+		FROM cb.get_context(%s)
+		''',
+	'user_is_registered': '''
+		SELECT id FROM player WHERE id = %s
+		''',
+	'blocked': '''
+		SELECT cb.blocked(%s, %s)
+		''',
+	'log_message': '''
+		INSERT INTO cb.message_log (
+			senderid,
+			recipientid,
+			message,
+			message_typeid
+		)
+		VALUES (%s, %s, %s, %s)
+		''',
+	'update_game': '''
+		SELECT  cb.update_game(
+			_gameid=>%s,
+			_boardstate=>%s,
+			_last_moved_at_utc=>%s,
+			_white_to_play=>%s,
+			_current_fen=>%s,
+			_position_hashes=>%s,
+			_undo=>%s,
+			_active=>%s,
+			_outcome=>%s)
+		''',
+	'apply_move': '''
+		SELECT cb.apply_move(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+		''',
+	'truncate_move': '''
+		SELECT cb.truncate_move(%s, %s, %s, %s, %s, %s)
+		''',
+	'set_undo_flag': '''
+		UPDATE games SET undo = %s WHERE id = %s
+		''',
+	# Two lookups, so each can be a backwards scan of its own index
+	'most_recent_gameid': '''
+		SELECT GREATEST(
+			(SELECT max(id) FROM games WHERE whiteplayer = %s),
+			(SELECT max(id) FROM games WHERE blackplayer = %s))
+		''',
+}
+
+# A statement the server no longer has (say, a pooler swapped the session), or one whose
+# result type changed because dbfuncs.sql was reloaded
+STALE_STATEMENT_CODES = {'26000', '0A000'}
+# Preparing a statement the session already has, which we must have lost track of
+DUPLICATE_PREPARED_STATEMENT = '42P05'
+
+def numbered_placeholders(sql):
+	'''%s placeholders to $1, $2, ... which is what PREPARE wants'''
+	counter = itertools.count(1)
+	return re.sub('%s', lambda _: f'${next(counter)}', sql)
+
+class PreparingConnection(psycopg2.extensions.connection):
+	'''Remembers which STATEMENTS it has prepared. A reconnect makes a new one of these,
+	which starts with none, so everything gets prepared again'''
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.prepared = set()
+
 # # Person = collections.namedtuple('Person', 'id nickname')
 # class Person:
 # 	def __init__(self, id, nickname):
@@ -35,14 +121,100 @@ Reminder = collections.namedtuple('Reminder', 'whiteplayerid, whiteplayer_nickna
 
 GameSummary = Reminder
 
+# One position of a game. move and san are what led to it, so they're None for the starting position
+HistoryEntry = collections.namedtuple('HistoryEntry', 'ply move san fen placement')
+
+# Boards used to be stored as the starting fen, then \xff, then a byte per move: its index into the
+# sorted legal moves (version 1). Version 2 starts with a \x02 (a fen never does), and stores each
+# move as two bytes: from square, to square and promotion piece, so decoding is a plain replay
+BOARD_FORMAT_VERSION = 2
+BOARD_FORMAT_V2 = b'\x02'
+
+# Every this many plies, the position is also stored in cb.game_checkpoint,
+# so that no position is ever more than this many moves of replay away
+CHECKPOINT_INTERVAL = 16
+
+# Recently walked game histories, for explore, replays and pgns
+MAX_HISTORIES = int(os.environ.get('MAX_HISTORIES', '64'))
+_histories = collections.OrderedDict()		# (gameid, plies) -> (raw board, [HistoryEntry])
+_histories_lock = threading.Lock()
+
+def pack_move(move):
+	'''from square in the low 6 bits, then to square, then the promotion piece type (0 for none)'''
+	packed = move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+	return packed.to_bytes(2, 'big')
+
+def unpack_move(packed):
+	packed = int.from_bytes(packed, 'big')
+	return chess.Move(packed & 63, packed >> 6 & 63, packed >> 12 or None)
+
+def stored_ply_count(raw_board):
+	'''How many moves a stored board has, without decoding any of them'''
+	if raw_board[:1] == BOARD_FORMAT_V2:
+		return len(raw_board[1:].split(b'\xff', 1)[1]) // 2
+	return len(raw_board.split(b'\xff', 1)[1])
+
+def image_url(fen, perspective=True, extension=''):
+	placement = fen.split()[0].replace('/','-')
+	query_arg = 'w' if perspective else 'b'
+
+	return (f'https://fbchessbot.herokuapp.com/board/{placement}{extension}'
+			f'?perspective={query_arg}')
+
+try:
+	zobrist_hash = chess.polyglot.zobrist_hash
+except AttributeError:
+	# Older python-chess only has it as a method
+	zobrist_hash = chess.Board.zobrist_hash
+
+# Each position's zobrist hash is stored as this many bytes, in games.position_hashes
+POSITION_HASH_SIZE = 8
+
+def position_hash(board):
+	return zobrist_hash(board).to_bytes(POSITION_HASH_SIZE, 'big')
+
+def count_repetitions(position_hashes, halfmove_clock):
+	'''How many times the last position in position_hashes has occurred. Only positions since the
+	last capture or pawn move can repeat it, and only every other one has the same side to move'''
+	size = POSITION_HASH_SIZE
+	last = len(position_hashes) // size - 1
+	current = position_hashes[size*last:]
+	first = max(0, last - halfmove_clock)
+	return sum(1 for i in range(last, first - 1, -2) if position_hashes[size*i:size*(i+1)] == current)
+
 class ChessBoard(chess.Board):
 	def __init__(self, fen=None):
 		if fen is None:
 			fen = chess.Board().fen()
 		super().__init__(fen, chess960=True)
+		# A board loaded from a checkpoint only has the moves since then. This is how many came before
+		self.base_ply = 0
+		self.start_fen = self.fen()
+
+	def game_ply(self):
+		'''How many moves have been played in the whole game'''
+		return self.base_ply + len(self.move_stack)
 
-	def to_byte_string(self):
+	def checkpoints(self, interval=CHECKPOINT_INTERVAL):
+		'''(ply, fen) every interval plies of the game'''
+		board = ChessBoard(self.original_fen())
+		out = []
+		for move in self.move_stack:
+			board.push(move)
+			if len(board.move_stack) % interval == 0:
+				out.append((len(board.move_stack), board.fen()))
+		return out
+
+	def to_byte_string(self, version=BOARD_FORMAT_VERSION):
+		if self.base_ply:
+			raise ValueError('Only part of the game was loaded, so it can\'t be saved whole')
 		original_fen = self.original_fen()
+		if version == 1:
+			return original_fen.encode('ascii') + b'\xff' + self._indexed_moves(original_fen)
+		return BOARD_FORMAT_V2 + original_fen.encode('ascii') + b'\xff' + b''.join(map(pack_move, self.move_stack))
+
+	def _indexed_moves(self, original_fen):
+		'''Version 1: each move is its index into the sorted legal moves'''
 		blank = ChessBoard(original_fen)
 		move_indices = []
 		for move in self.move_stack:
@@ -52,7 +224,7 @@ class ChessBoard(chess.Board):
 
 		# Hopefully there can only ever be 255 legal moves in chess...
 		# Pretty sure it's true for regular chess...maybe wrong for not real chess
-		return original_fen.encode('ascii') + b'\xff' + bytes(move_indices)
+		return bytes(move_indices)
 
 	@staticmethod
 	def _order_moves(board):
@@ -60,40 +232,60 @@ class ChessBoard(chess.Board):
 		return sorted(board.legal_moves, key=lambda move: move.uci())
 
 	@classmethod
-	def from_byte_string(cls, bytestring):
-		original_fen, moves = bytestring.split(b'\xff')
+	def from_byte_string(cls, bytestring, checkpoint=None):
+		'''checkpoint is an optional (ply, fen) to start from instead of the beginning. The board will
+		then only have the moves since, which is enough to play on and undo, but not to save whole'''
+		if bytestring[:1] == BOARD_FORMAT_V2:
+			original_fen, moves = bytestring[1:].split(b'\xff', 1)
+			start = 0
+			if checkpoint is not None and checkpoint[0] < len(moves) // 2:
+				start, fen = checkpoint
+				out = cls(fen)
+				out.base_ply = start
+			else:
+				out = cls(original_fen.decode('ascii'))
+			# The moves were legal when they were saved, so no need to generate anything
+			for i in range(2*start, len(moves), 2):
+				out.push(unpack_move(moves[i:i+2]))
+			return out
+
+		original_fen, moves = bytestring.split(b'\xff', 1)
 		out = cls(original_fen.decode('ascii'))
 		for byte in moves:
 			legal_moves = cls._order_moves(out)
 			out.push(legal_moves[byte])
 		return out
 
-	# TODO the only reason I have this is for my test framework...maybe remove???
 	def original_fen(self):
-		'''The fen that the game started with (not necessarily standard position)'''
-		board = self.copy()			# This will actually be a standard chess.Board, not a ChessBoard
-		while board.move_stack:
-			board.pop()
-		return board.fen()
-
-	def image_url(self, perspective=True):
-		fen = self.fen().split()[0].replace('/','-')
-		query_arg = 'w' if perspective else 'b'
-
-		return (f'https://fbchessbot.herokuapp.com/board/{fen}'
-				f'?perspective={query_arg}')
+		'''The fen that the game started with (not necessarily standard position).
+		For a board loaded from a checkpoint, that's the checkpoint'''
+		return self.start_fen
+
+	def history(self):
+		'''Every position from the start to now as HistoryEntry's, replaying forwards once'''
+		board = ChessBoard(self.start_fen)
+		ply = self.base_ply
+		yield HistoryEntry(ply, None, None, board.fen(), board.board_fen())
+		for move in self.move_stack:
+			san = board.san(move)
+			board.push(move)
+			ply += 1
+			yield HistoryEntry(ply, move, san, board.fen(), board.board_fen())
+
+	def position_hashes(self):
+		'''position_hash of every position from the start to now, as one string'''
+		board = ChessBoard(self.start_fen)
+		out = [position_hash(board)]
+		for move in self.move_stack:
+			board.push(move)
+			out.append(position_hash(board))
+		return b''.join(out)
 
-	def get_img_urls(self):
-		out = []
-		while self.move_stack:
-			self.pop()
-			out.append({
-				"url": self.image_url(),
-				"fen": self.fen()
-				})
-			# out.append(self.image_url())
+	def image_url(self, perspective=True, extension=''):
+		return image_url(self.fen(), perspective, extension)
 
-		return list(reversed(out))
+	def get_img_urls(self, extension=''):
+		return history_img_urls(self.history(), extension)
 
 		# BLACK = False
 		# fen = self.board.fen().split()[0]
@@ -115,10 +307,22 @@ class ChessBoard(chess.Board):
 	# 	return list(reversed(out))
 
 
+def history_img_urls(history, extension=''):
+	return [{'url': image_url(entry.fen, extension=extension), 'fen': entry.fen} for entry in history]
+
+
 class Game:
-	def __init__(self, id, raw_board, active, whiteplayer, blackplayer, undo, outcome, last_moved_at_utc):
+	def __init__(self, id, raw_board, active, whiteplayer, blackplayer, undo, outcome, last_moved_at_utc, white_to_play=None,
+			checkpoint=None, position_hashes=None):
 		self.id = id
-		self.board = ChessBoard.from_byte_string(raw_board)
+		# Decoding replays the game (from the last checkpoint, if there is one), and plenty of
+		# commands never look at the position, so that waits until someone asks for the board
+		self.raw_board = raw_board
+		self.checkpoint = checkpoint
+		self._board = None
+		self.white_to_play = white_to_play
+		# Kept up to date by DB.apply_move and pop_move. Missing for games that predate it
+		self.position_hashes = position_hashes
 
 		self.active = active
 		self.whiteplayer = whiteplayer
@@ -127,6 +331,47 @@ class Game:
 		self.outcome = outcome
 		self.last_moved_at_utc = last_moved_at_utc
 
+	@property
+	def board(self):
+		if self._board is None:
+			self._board = ChessBoard.from_byte_string(self.raw_board, self.checkpoint)
+		return self._board
+
+	@board.setter
+	def board(self, board):
+		self._board = board
+
+	@property
+	def turn(self):
+		'''Whose turn it is, without decoding the board if it can be helped'''
+		if self._board is None and self.white_to_play is not None:
+			return self.white_to_play
+		return self.board.turn
+
+	def repetitions(self):
+		'''How many times the current position has occurred, or None if we don't know'''
+		position_hashes = self.position_hashes
+		if not position_hashes:
+			return None
+		if len(position_hashes) // POSITION_HASH_SIZE == self.board.game_ply():
+			# The last move hasn't been saved yet
+			position_hashes += position_hash(self.board)
+		return count_repetitions(position_hashes, self.board.halfmove_clock)
+
+	def draw_reason(self):
+		'''Why the game is over as a draw, or None if it isn't.
+		Repetition comes from the stored hashes, since the board may only have its last few moves'''
+		board = self.board
+		if board.is_stalemate():
+			return 'Stalemate'
+		if board.is_insufficient_material():
+			return 'Insufficient material'
+		if board.halfmove_clock >= 100:
+			return 'Fifty moves without a capture or pawn move'
+		if (self.repetitions() or 0) >= 3:
+			return 'Threefold repetition'
+		return None
+
 	# @classmethod
 	# def fromboard(cls, board):
 	# 	return cls(None, )
@@ -172,13 +417,13 @@ class Game:
 	def is_active_player(self, playerid):
 		playerid = int(playerid)
 		WHITE = True
-		if self.board.turn == WHITE:        
+		if self.turn == WHITE:        
 			return playerid == self.whiteplayer.id
 		else:
 			return playerid == self.blackplayer.id
 
 	def is_active_color(self, color):
-		return self.board.turn == color
+		return self.turn == color
 
 	def get_opponent(self, playerid):
 		playerid = int(playerid)
@@ -189,27 +434,36 @@ class Game:
 		else:
 			raise ValueError(f'{playerid} is not in this game. {self.blackplayer}, {self.whiteplayer}')
 
+def connect(autocommit=True):
+	try:
+		url = urlparse(DATABASE_URL)
+		conn = psycopg2.connect(
+			database=url.path[1:],
+			user=url.username,
+			password=url.password,
+			host=url.hostname,
+			port=url.port,
+			connection_factory=PreparingConnection
+		)
+	except psycopg2.OperationalError:
+		# This happens when we're testing against
+		# our local postgres db (hack)
+		conn = psycopg2.connect(DATABASE_URL, connection_factory=PreparingConnection)
+	conn.autocommit = autocommit
+	return conn
+
 class DB:
 	def __init__(self):
-		try:
-			url = urlparse(DATABASE_URL)
-			self.conn = psycopg2.connect(
-				database=url.path[1:],
-				user=url.username,
-				password=url.password,
-				host=url.hostname,
-				port=url.port
-			)
-		except psycopg2.OperationalError:
-			# This happens when we're testing against
-			# our local postgres db (hack)
-			self.conn = psycopg2.connect(DATABASE_URL)
-		self.conn.autocommit = True
+		# Nothing connects until the first query, so importing this before a fork is fine
+		self.pool = dbpool.ConnectionPool(connect, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_AFTER)
+		self.prepare_statements = PREPARE_STATEMENTS
 		self.now_provider = datetime.datetime
 		# self.now_provider = None
+		# Called with the board whenever a game's position is saved
+		self.board_listeners = []
 
 	def __del__(self):
-		self.conn.close()
+		self.pool.close()
 
 	def delete_all(self):
 		with self.cursor() as cur:
@@ -224,9 +478,49 @@ class DB:
 				''')
 			# cur.connection.commit()
 
+	def _board_saved(self, board):
+		for listener in self.board_listeners:
+			try:
+				listener(board)
+			except Exception as e:
+				# Never let this get in the way of saving
+				print('Error in board listener:', repr(e))
+
+	@contextlib.contextmanager
 	def cursor(self):
-		# return self.conn.cursor()
-		return self.conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
+		'''A cursor on a connection of its own, which goes back to the pool afterwards'''
+		with self.pool.connection() as conn:
+			with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cur:
+				yield cur
+
+	def execute(self, cur, name, args):
+		'''Runs STATEMENTS[name] on cur, by name if it's been prepared on cur's connection'''
+		conn = cur.connection
+		if not self.prepare_statements:
+			cur.execute(STATEMENTS[name], args)
+			return
+
+		execute = f'EXECUTE {name} ({", ".join(["%s"] * len(args))})'
+		for retry in [False, True]:
+			try:
+				if name not in conn.prepared:
+					self._prepare(cur, name)
+				cur.execute(execute, args)
+				return
+			except psycopg2.DatabaseError as e:
+				if retry or e.pgcode not in STALE_STATEMENT_CODES:
+					raise
+				# Start over with this connection
+				cur.execute('DEALLOCATE ALL')
+				conn.prepared = set()
+
+	def _prepare(self, cur, name):
+		try:
+			cur.execute(f'PREPARE {name} AS {numbered_placeholders(STATEMENTS[name])}')
+		except psycopg2.DatabaseError as e:
+			if e.pgcode != DUPLICATE_PREPARED_STATEMENT:
+				raise
+		cur.connection.prepared.add(name)
 
 	# def get_stats(self, playerid):
 	# 	pass
@@ -235,25 +529,75 @@ class DB:
 	# 	pass
 
 	# Just saves the serialized board
-	def save_game(self, game):
+	def save_game(self, game, undo=None, outcome=None):
+		'''undo and outcome are saved too, if given. An outcome ends the game'''
 		with self.cursor() as cur:
+			boardbytes = game.serialized()
+			game.position_hashes = game.board.position_hashes()
+			self.execute(cur, 'update_game', [game.id, boardbytes, self.now_provider.utcnow(), game.board.turn == chess.WHITE, game.board.fen(),
+					game.position_hashes, undo, False if outcome else None, int(outcome) if outcome else None])
+			# The whole history may have changed, so the checkpoints go too
+			checkpoints = game.board.checkpoints()
 			cur.execute('''
-				SELECT  cb.update_game(
-					_gameid=>%s,
-					_boardstate=>%s,
-					_last_moved_at_utc=>%s,
-					_white_to_play=>%s);
-				''', [game.id, game.serialized(), self.now_provider.utcnow(), game.is_active_player(constants.WHITE)])
+				SELECT cb.set_checkpoints(%s, %s, %s)
+				''', [game.id, [ply for ply, _ in checkpoints], [fen for _, fen in checkpoints]])
 			# cur.execute('''
 			# 	UPDATE games SET board = %s WHERE id = %s
 			# 	''', [game.serialized(), game.id])
 			# cur.connection.commit()
+		self._board_saved(game.board)
+
+	def apply_move(self, game, playerid, outcome=None):
+		'''Saves the move playerid just pushed onto game.board, clears the undo flag, and sets the
+		outcome if the move ended the game, all in one statement. Returns False, having saved nothing,
+		if it isn't playerid's turn or the game isn't as it was when it was loaded'''
+		board = game.board
+		if game.raw_board[:1] != BOARD_FORMAT_V2:
+			# Old format, so the whole board is rewritten (and converted) instead. That still
+			# saves everything at once, but can't check the turn along the way
+			self.save_game(game, undo=False, outcome=outcome)
+		else:
+			with self.cursor() as cur:
+				ply = board.game_ply()
+				checkpoint_fen = board.fen() if ply % CHECKPOINT_INTERVAL == 0 else None
+				new_hash = position_hash(board)
+				self.execute(cur, 'apply_move', [game.id, playerid, pack_move(board.peek()), ply, self.now_provider.utcnow(),
+					board.turn == chess.WHITE, board.fen(), checkpoint_fen, new_hash, int(outcome) if outcome else None])
+				if not cur.fetchone()[0]:
+					return False
+			if game.position_hashes is not None:
+				game.position_hashes += new_hash
+			self._board_saved(board)
+
+		game.undo = False
+		if outcome:
+			game.active, game.outcome = False, outcome
+		return True
+
+	def pop_move(self, game, playerid):
+		'''Saves playerid accepting an undo (game.board has already been popped): drops the last stored
+		move and clears the undo request in one statement. Returns False, having saved nothing, if no
+		undo was requested, it isn't playerid's turn, or the game isn't as it was when it was loaded'''
+		board = game.board
+		if game.raw_board[:1] != BOARD_FORMAT_V2:
+			# Old format, so the whole board is rewritten (and converted) instead
+			self.save_game(game, undo=False)
+		else:
+			with self.cursor() as cur:
+				self.execute(cur, 'truncate_move', [game.id, playerid, board.game_ply(), self.now_provider.utcnow(),
+					board.turn == chess.WHITE, board.fen()])
+				if not cur.fetchone()[0]:
+					return False
+			if game.position_hashes is not None:
+				game.position_hashes = game.position_hashes[:-POSITION_HASH_SIZE]
+			self._board_saved(board)
+
+		game.undo = False
+		return True
 
 	def set_undo_flag(self, game, undo_flag):
 		with self.cursor() as cur:
-			cur.execute('''
-				UPDATE games SET undo = %s WHERE id = %s
-				''', [undo_flag, game.id])
+			self.execute(cur, 'set_undo_flag', [undo_flag, game.id])
 			# cur.connection.commit()
 
 	# Also 'finishes' the game by setting active to false
@@ -275,19 +619,16 @@ class DB:
 			white_to_play = board.turn
 
 			cur.execute('''
-				SELECT cb.create_game(%s, %s, %s, %s, %s)
-				''', [whiteplayer, blackplayer, boardbytes, self.now_provider.utcnow(), white_to_play])
+				SELECT cb.create_game(%s, %s, %s, %s, %s, %s, %s)
+				''', [whiteplayer, blackplayer, boardbytes, self.now_provider.utcnow(), white_to_play, board.fen(),
+					position_hash(board)])
+		self._board_saved(board)
 
 	# TODO wrap this into a form of search_games...?
 	# Returns specified Player, opponent Player, active Game
 	def get_context(self, playerid):
 		with self.cursor() as cur:
-			cur.execute('''
-				SELECT playerid, player_nickname, player_opponentid, player_active,
-					opponentid, opponent_nickname, opponent_opponentid, opponent_active,
-					gameid, board, active, whiteplayer, blackplayer, undo, outcome, last_moved_at_utc
-				FROM cb.get_context(%s)
-				''', [playerid])
+			self.execute(cur, 'get_context', [playerid])
 			# cur.connection.commit()
 			row = cur.fetchone()
 			if row is None:						# user isn't even registered
@@ -316,7 +657,10 @@ class DB:
 			if row.gameid is None:
 				game = None
 			else:
-				game = Game(row.gameid, bytes(row.board), row.active, whiteplayer, blackplayer, row.undo, row.outcome, row.last_moved_at_utc)
+				checkpoint = None if row.checkpoint_ply is None else (row.checkpoint_ply, row.checkpoint_fen)
+				position_hashes = bytes(row.position_hashes) if row.position_hashes is not None else None
+				game = Game(row.gameid, bytes(row.board), row.active, whiteplayer, blackplayer, row.undo, row.outcome, row.last_moved_at_utc,
+					row.white_to_play, checkpoint, position_hashes)
 
 			return player, opponent, game
 
@@ -332,13 +676,37 @@ class DB:
 	# 		id, raw_board, active, whiteplayer, blackplayer, undo, outcome):
 	def get_most_recent_gameid(self, playerid):
 		with self.cursor() as cur:
-			cur.execute("""
-				SELECT max(id) FROM games WHERE (blackplayer = %s OR whiteplayer = %s)
-				""", [playerid, playerid])
+			self.execute(cur, 'most_recent_gameid', [playerid, playerid])
 			# cur.connection.commit()
 			return cur.fetchone()[0]
 
 
+	def game_history(self, gameid):
+		'''The game's HistoryEntry's, from its start to now, or None if there's no such game.
+		Replaying means generating every san, so the result is kept until the game changes'''
+		with self.cursor() as cur:
+			cur.execute('SELECT board FROM games WHERE id = %s', [gameid])
+			row = cur.fetchone()
+		if row is None:
+			return None
+		raw_board = bytes(row[0])
+
+		key = (int(gameid), stored_ply_count(raw_board))
+		with _histories_lock:
+			cached = _histories.get(key)
+			# An undo then a different move keeps the ply count, so check it really is the same game
+			if cached is not None and cached[0] == raw_board:
+				_histories.move_to_end(key)
+				return cached[1]
+
+		history = list(ChessBoard.from_byte_string(raw_board).history())
+		with _histories_lock:
+			_histories[key] = (raw_board, history)
+			_histories.move_to_end(key)
+			while len(_histories) > MAX_HISTORIES:
+				_histories.popitem(last=False)
+		return history
+
 	def board_from_id(self, gameid):
 		with self.cursor() as cur:
 			cur.execute("""
@@ -400,7 +768,7 @@ class DB:
 
 	def user_is_registered(self, playerid):
 		with self.cursor() as cur:
-			cur.execute('SELECT id FROM player WHERE id = %s', [playerid])
+			self.execute(cur, 'user_is_registered', [playerid])
 			result = cur.fetchone()
 			# cur.connection.commit()
 			return result is not None
@@ -436,26 +804,29 @@ class DB:
 
 	def is_blocked(self, playerid, otherid):
 		with self.cursor() as cur:
-			cur.execute('''
-				SELECT cb.blocked(%s, %s)
-				''', [playerid, otherid])
+			self.execute(cur, 'blocked', [playerid, otherid])
 			# cur.connection.commit()
 			result = cur.fetchone()[0]
 			return [(result & 1 > 0), (result & 2 > 0)]
 
 	def log_message(self, message, message_type, *, senderid=None, recipientid=None):
 		with self.cursor() as cur:
-			# TODO make a function I guess
-			cur.execute('''
+			self.execute(cur, 'log_message', [senderid, recipientid, message, int(message_type)])
+			# cur.connection.commit()
+
+	def log_messages(self, entries):
+		'''Logs many (message, message_type, senderid, recipientid) in one insert'''
+		with self.cursor() as cur:
+			psycopg2.extras.execute_values(cur, '''
 				INSERT INTO cb.message_log (
-					senderid,
-					recipientid,
 					message,
-					message_typeid
+					message_typeid,
+					senderid,
+					recipientid
 				)
-				VALUES (%s, %s, %s, %s)
-				''', [senderid, recipientid, message, int(message_type)])
-			# cur.connection.commit()
+				VALUES %s
+				''', [(message, int(message_type), senderid, recipientid) for message, message_type, senderid, recipientid in entries],
+				page_size=1000)
 
 	def deactivate_player(self, playerid):
 		with self.cursor() as cur:
@@ -88,7 +88,7 @@ RETURNS TABLE (
 	playerid BIGINT, player_nickname VARCHAR(32), player_opponentid BIGINT, player_active BOOLEAN,
 	opponentid BIGINT, opponent_nickname VARCHAR(32), opponent_opponentid BIGINT, opponent_active BOOLEAN,
 	gameid INT, board BYTEA, active BOOLEAN, whiteplayer BIGINT, blackplayer BIGINT, undo BOOLEAN, outcome INT,
-	last_moved_at_utc TIMESTAMP
+	last_moved_at_utc TIMESTAMP, white_to_play BOOLEAN, checkpoint_ply INT, checkpoint_fen TEXT, position_hashes BYTEA
 )
 AS
 $$
@@ -96,7 +96,8 @@ BEGIN
 	RETURN QUERY SELECT
 		p.id AS playerid, p.nickname AS player_nickname, p.opponent_context AS player_opponentid, p.active AS player_active,
 		o.id AS opponentid, o.nickname AS opponent_nickname, o.opponent_context AS opponent_opponentid, o.active AS opponent_active,
-		g.id AS gameid, g.board, g.active, g.whiteplayer, g.blackplayer, g.undo, g.outcome, g.last_moved_at_utc
+		g.id AS gameid, g.board, g.active, g.whiteplayer, g.blackplayer, g.undo, g.outcome, g.last_moved_at_utc, g.white_to_play,
+		c.ply AS checkpoint_ply, c.fen AS checkpoint_fen, g.position_hashes
 	FROM player p
 	LEFT JOIN player o ON p.opponent_context = o.id
 	LEFT JOIN games g ON (
@@ -105,6 +106,16 @@ BEGIN
 			(g.blackplayer = p.id AND g.whiteplayer = o.id)
 		)
 		AND (g.active = TRUE)
+	-- The latest checkpoint with at least one move after it, so that the move can still be undone
+	LEFT JOIN LATERAL (
+		SELECT gc.ply, gc.fen
+		FROM cb.game_checkpoint gc
+		WHERE gc.gameid = g.id
+			AND get_byte(g.board, 0) = 2
+			AND gc.ply < (length(g.board) - position('\xff'::bytea IN g.board)) / 2
+		ORDER BY gc.ply DESC
+		LIMIT 1
+	) c ON TRUE
 	WHERE p.id = _playerid;
 END
 $$ LANGUAGE plpgsql;
@@ -117,7 +128,9 @@ CREATE OR REPLACE FUNCTION cb.update_game(
 	_active BOOLEAN = NULL,
 	_outcome INT = NULL,
 	_last_moved_at_utc TIMESTAMP = NULL,
-	_white_to_play BOOLEAN = NULL
+	_white_to_play BOOLEAN = NULL,
+	_current_fen TEXT = NULL,
+	_position_hashes BYTEA = NULL
 )
 RETURNS VOID
 AS
@@ -130,13 +143,131 @@ BEGIN
 		active = COALESCE(_active, active),
 		outcome = COALESCE(_outcome, outcome),
 		last_moved_at_utc = COALESCE(_last_moved_at_utc, last_moved_at_utc),
-		white_to_play = COALESCE(_white_to_play, white_to_play)
+		white_to_play = COALESCE(_white_to_play, white_to_play),
+		current_fen = COALESCE(_current_fen, current_fen),
+		position_hashes = COALESCE(_position_hashes, position_hashes)
 	WHERE id = _gameid;
 
 END
 $$ LANGUAGE plpgsql;
 
 
+-- Replaces all of a game's checkpoints, for when the whole board has been rewritten
+CREATE OR REPLACE FUNCTION cb.set_checkpoints(
+	_gameid INT,
+	_plies INT[],
+	_fens TEXT[]
+)
+RETURNS VOID
+AS
+$$
+BEGIN
+	DELETE FROM cb.game_checkpoint WHERE gameid = _gameid;
+
+	INSERT INTO cb.game_checkpoint (gameid, ply, fen)
+	SELECT _gameid, checkpoint.ply, checkpoint.fen
+	FROM unnest(_plies, _fens) AS checkpoint(ply, fen);
+END
+$$ LANGUAGE plpgsql;
+
+
+-- Everything a move changes, in one statement: appends the packed move, clears any undo request,
+-- and sets the outcome (ending the game) if the move ended it. Nothing is saved, and FALSE is
+-- returned, unless the game is still active, it's _playerid's turn, and _ply is the ply this move
+-- makes (so the game hasn't changed since it was loaded). Only for boards in the packed format
+-- _checkpoint_fen is only given every so many plies, when the new position should be checkpointed.
+-- _position_hash is the new position's 8 byte zobrist hash, for spotting repetitions
+CREATE OR REPLACE FUNCTION cb.apply_move(
+	_gameid INT,
+	_playerid BIGINT,
+	_move BYTEA,
+	_ply INT,
+	_last_moved_at_utc TIMESTAMP,
+	_white_to_play BOOLEAN,
+	_current_fen TEXT,
+	_checkpoint_fen TEXT = NULL,
+	_position_hash BYTEA = NULL,
+	_outcome INT = NULL
+)
+RETURNS BOOLEAN
+AS
+$$
+BEGIN
+	UPDATE games SET
+		board = board || _move,
+		undo = FALSE,
+		active = (_outcome IS NULL),
+		outcome = _outcome,
+		last_moved_at_utc = _last_moved_at_utc,
+		white_to_play = _white_to_play,
+		current_fen = _current_fen,
+		-- Stays NULL for games whose hashes were never filled in
+		position_hashes = position_hashes || _position_hash
+	WHERE id = _gameid
+		AND active = TRUE
+		AND get_byte(board, 0) = 2
+		AND (length(board) - position('\xff'::bytea IN board)) / 2 = _ply - 1
+		AND CASE WHEN white_to_play THEN whiteplayer ELSE blackplayer END = _playerid;
+
+	IF NOT FOUND THEN
+		RETURN FALSE;
+	END IF;
+
+	IF _checkpoint_fen IS NOT NULL THEN
+		INSERT INTO cb.game_checkpoint (gameid, ply, fen)
+		VALUES (_gameid, _ply, _checkpoint_fen)
+		ON CONFLICT (gameid, ply) DO UPDATE SET fen = _checkpoint_fen;
+	END IF;
+
+	RETURN TRUE;
+END
+$$ LANGUAGE plpgsql;
+
+
+-- Accepts an undo: drops the last packed move (2 bytes) off the stored board and clears the undo
+-- request, in one statement. Nothing is saved, and FALSE is returned, unless the game is still
+-- active, an undo was requested, it's _playerid's turn (the player accepting it), and _ply is the
+-- ply the undo goes back to (so the game hasn't changed since it was loaded). Only for boards in
+-- the packed format
+CREATE OR REPLACE FUNCTION cb.truncate_move(
+	_gameid INT,
+	_playerid BIGINT,
+	_ply INT,
+	_last_moved_at_utc TIMESTAMP,
+	_white_to_play BOOLEAN,
+	_current_fen TEXT
+)
+RETURNS BOOLEAN
+AS
+$$
+BEGIN
+	UPDATE games SET
+		board = substring(board FROM 1 FOR length(board) - 2),
+		undo = FALSE,
+		last_moved_at_utc = _last_moved_at_utc,
+		white_to_play = _white_to_play,
+		current_fen = _current_fen,
+		position_hashes = substring(position_hashes FROM 1 FOR length(position_hashes) - 8)
+	WHERE id = _gameid
+		AND active = TRUE
+		AND undo = TRUE
+		AND get_byte(board, 0) = 2
+		-- Everything after the \xff that ends the fen is moves
+		AND (length(board) - position('\xff'::bytea IN board)) / 2 = _ply + 1
+		AND CASE WHEN white_to_play THEN whiteplayer ELSE blackplayer END = _playerid;
+
+	IF NOT FOUND THEN
+		RETURN FALSE;
+	END IF;
+
+	-- A checkpoint of the position that was just undone
+	DELETE FROM cb.game_checkpoint WHERE gameid = _gameid AND ply > _ply;
+
+	RETURN TRUE;
+END
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION cb.search_games(
 	_now_utc TIMESTAMP
 	, _gameid INT = NULL
@@ -200,7 +331,9 @@ CREATE OR REPLACE FUNCTION cb.create_game(
 	_blackplayerid BIGINT,
 	_initial_board_state BYTEA,
 	_created_at_utc TIMESTAMP,
-	_white_to_play BOOLEAN
+	_white_to_play BOOLEAN,
+	_current_fen TEXT = NULL,
+	_position_hashes BYTEA = NULL
 )
 RETURNS VOID
 AS
@@ -221,7 +354,9 @@ BEGIN
 			blackplayer, 
 			undo, 
 			created_at_utc,
-			white_to_play
+			white_to_play,
+			current_fen,
+			position_hashes
 		) 
 		VALUES (
 			_initial_board_state, 
@@ -230,7 +365,9 @@ BEGIN
 			_blackplayerid, 
 			FALSE, 
 			_created_at_utc,
-			_white_to_play
+			_white_to_play,
+			_current_fen,
+			_position_hashes
 		);
 	-- TODO return the new game id?
 END
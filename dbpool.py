@@ -0,0 +1,177 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+
+import forksafe
+
+class ConnectionPool(forksafe.ForkSafe):
+	'''Postgres connections shared between threads, each checked out for one operation at a time.
+
+	Up to maxconn connections are opened, as they're needed (and minconn as soon as the pool is first used).
+	Asking for one when they're all in use waits up to timeout seconds. A connection that has been idle
+	for more than check_after seconds is checked before it's handed out, and replaced if it has died'''
+	def __init__(self, connect, minconn=1, maxconn=10, timeout=30, check_after=30):
+		self.connect = connect
+		self.minconn = minconn
+		self.maxconn = maxconn
+		self.timeout = timeout
+		self.check_after = check_after
+		self.lock = threading.Lock()
+		self.connections = set()			# Every open connection, idle or not
+
+		self.checkouts = 0
+		self.total_wait = 0
+		self.max_wait = 0
+		self.timeouts = 0
+		self.reconnects = 0
+
+	def _start(self):
+		# Anything from before a fork belongs to the parent
+		for conn in self.connections:
+			self._disown(conn)
+		self.connections = set()
+		self.idle = collections.deque()		# (connection, last used), most recently used last
+		self.in_use = 0
+		self.slots = threading.BoundedSemaphore(self.maxconn)
+
+	def _fill(self):
+		'''Tops the pool up to minconn connections'''
+		with self.lock:
+			missing = self.minconn - len(self.idle) - self.in_use
+		for _ in range(missing):
+			conn = self._connect()
+			with self.lock:
+				self.idle.appendleft((conn, time.monotonic()))
+
+	def _connect(self):
+		conn = self.connect()
+		with self.lock:
+			self.connections.add(conn)
+		return conn
+
+	def _disown(self, conn):
+		'''conn was inherited through a fork. Closing it (or it being garbage collected) would tell the
+		server we're done with it, which would end it for the parent too. So the child's copy of its
+		socket is pointed at /dev/null first'''
+		try:
+			fd = conn.fileno()
+		except psycopg2.Error:
+			return
+		devnull = os.open(os.devnull, os.O_RDWR)
+		os.dup2(devnull, fd)
+		os.close(devnull)
+
+	def _alive(self, conn):
+		if conn.closed:
+			return False
+		try:
+			with conn.cursor() as cur:
+				cur.execute('SELECT 1')
+			return True
+		except psycopg2.Error:
+			return False
+
+	def getconn(self):
+		'''A connection and the pid it belongs to. Give both back to putconn'''
+		if self._ensure_started():
+			self._fill()
+		with self.lock:
+			slots = self.slots
+
+		start = time.monotonic()
+		if not slots.acquire(timeout=self.timeout):
+			with self.lock:
+				self.timeouts += 1
+			raise psycopg2.pool.PoolError(f'No database connection came free in {self.timeout}s')
+		waited = time.monotonic() - start
+
+		try:
+			with self.lock:
+				pid = self._pid
+				self.in_use += 1
+				self.checkouts += 1
+				self.total_wait += waited
+				self.max_wait = max(self.max_wait, waited)
+				conn, last_used = self.idle.pop() if self.idle else (None, None)
+
+			if conn is not None and (conn.closed or time.monotonic() - last_used > self.check_after) and not self._alive(conn):
+				self._close(conn)
+				conn = None
+				with self.lock:
+					self.reconnects += 1
+			if conn is None:
+				conn = self._connect()
+		except BaseException:
+			with self.lock:
+				self.in_use -= 1
+			slots.release()
+			raise
+		return conn, pid
+
+	def putconn(self, conn, pid, discard=False):
+		with self.lock:
+			if pid != self._pid:
+				# Checked out before a fork, so it's the parent's (and has been disowned)
+				return
+			self.in_use -= 1
+			if not (discard or conn.closed):
+				self.idle.append((conn, time.monotonic()))
+				conn = None
+			slots = self.slots
+		if conn is not None:
+			self._close(conn)
+		slots.release()
+
+	def _close(self, conn):
+		with self.lock:
+			self.connections.discard(conn)
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+
+	@contextlib.contextmanager
+	def connection(self):
+		conn, pid = self.getconn()
+		discard = False
+		try:
+			yield conn
+		except (psycopg2.OperationalError, psycopg2.InterfaceError):
+			# The connection may well be dead, so nobody else gets it
+			discard = True
+			raise
+		finally:
+			self.putconn(conn, pid, discard)
+
+	def close(self):
+		'''Closes the idle connections that belong to this process'''
+		if not self._started():
+			return
+		with self.lock:
+			idle, self.idle = self.idle, collections.deque()
+		for conn, _ in idle:
+			self._close(conn)
+
+	def stats(self):
+		in_use = idle = 0
+		# Until then, the lock may be one that a fork left held
+		if self._started():
+			with self.lock:
+				in_use, idle = self.in_use, len(self.idle)
+		return {
+			'min': self.minconn,
+			'max': self.maxconn,
+			'in_use': in_use,
+			'idle': idle,
+			'utilization': in_use / self.maxconn,
+			'checkouts': self.checkouts,
+			'average_wait_ms': 1000 * self.total_wait / self.checkouts if self.checkouts else 0,
+			'max_wait_ms': 1000 * self.max_wait,
+			'timeouts': self.timeouts,
+			'reconnects': self.reconnects,
+		}
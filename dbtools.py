@@ -410,4 +410,81 @@ def migration18():
 
 	cur.execute(f'''
 		DROP TABLE IF EXISTS cb.player_blockage;
-	''')
\ No newline at end of file
+	''')
+
+@register_migration
+def migration19():
+	import dbactions
+	op()
+	# save_game used to store white_to_play wrong, and Game now trusts it for whose turn it is
+	cur.execute('''
+		SELECT id, board FROM games
+		''')
+	boards = list(cur)
+	for id, board in boards:
+		turn = dbactions.ChessBoard.from_byte_string(bytes(board)).turn
+		cur.execute('''
+			UPDATE games SET white_to_play = %s WHERE id = %s
+			''', [turn, id])
+	cur.connection.commit()
+
+@register_migration
+def migration20():
+	import dbactions
+	op()
+	cur.execute('''
+		ALTER TABLE games ADD COLUMN current_fen TEXT
+		''')
+	cur.execute('''
+		CREATE TABLE IF NOT EXISTS cb.game_checkpoint (
+			gameid INT REFERENCES games(id) ON DELETE CASCADE,
+			ply INT,
+			fen TEXT NOT NULL,
+			PRIMARY KEY (gameid, ply)
+		)
+		''')
+	cur.execute('''
+		SELECT id, board FROM games
+		''')
+	boards = list(cur)
+	for id, board in boards:
+		board = dbactions.ChessBoard.from_byte_string(bytes(board))
+		cur.execute('''
+			UPDATE games SET current_fen = %s WHERE id = %s
+			''', [board.fen(), id])
+		cur.executemany('''
+			INSERT INTO cb.game_checkpoint (gameid, ply, fen) VALUES (%s, %s, %s)
+			''', [(id, ply, fen) for ply, fen in board.checkpoints()])
+	cur.connection.commit()
+
+@register_migration
+def migration21():
+	import bulkboards
+	op()
+	cur.execute('''
+		ALTER TABLE games ADD COLUMN position_hashes BYTEA
+		''')
+	cur.connection.commit()
+	# Rewriting every board fills in the hashes along with everything else
+	bulkboards.reencode_boards(state_file=None)
+
+@register_migration
+def migration22():
+	op()
+	# cb.get_playerid looks nicknames up case insensitively
+	cur.execute('''
+		CREATE INDEX IF NOT EXISTS ix_player_lower_nickname ON player (lower(nickname))
+		''')
+	# cb.get_context finds the active game between two players, whichever of them is white
+	cur.execute('''
+		CREATE INDEX IF NOT EXISTS ix_games_active_players ON games (whiteplayer, blackplayer) WHERE active
+		''')
+	# The latest game a player was in, from either side. These also back the foreign keys to player
+	cur.execute('''
+		CREATE INDEX IF NOT EXISTS ix_games_whiteplayer_id ON games (whiteplayer, id)
+		''')
+	cur.execute('''
+		CREATE INDEX IF NOT EXISTS ix_games_blackplayer_id ON games (blackplayer, id)
+		''')
+	# cb.blocked looks relationships up by both players, which UX_initiating_receiving already covers
+	cur.connection.commit()
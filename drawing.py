@@ -1,41 +1,354 @@
-from PIL import Image#, ImageDraw
+import collections
+import io
+import os
+import threading
 
-from dbactions import ChessBoard
+from PIL import Image, ImageDraw, ImageFont
 
 BORDER = 30
+SQUARE = 64
+FRAME_SIZE = 2*BORDER + 8*SQUARE
 
-def create_board_image(fen, iswhite, board_image_name):
-	board = ChessBoard(fen)
-	board_string_array = str(board).replace(' ', '').split('\n')
+# Square sizes boards can be drawn at. The sprites are 64px, so nothing bigger
+SQUARE_SIZES = [16, 24, 32, 48, 64]
+# Below this the coordinates would be unreadable anyway, so thumbnails have no border
+MIN_LABELLED_SQUARE = 32
+LABEL_FONT = 'arial.ttf'
 
-	if iswhite:
-		file = 'board_white.png'
-	else:
-		file = 'board_black.png'
-		board_string_array = [reversed(row) for row in reversed(board_string_array)]
-	# file = 'board_white.png' if is_white else 'board_black.png'
-	piece_image_map = {
-		'r': 'sprites/blackrook.png',
-		'n': 'sprites/blackknight.png',
-		'b': 'sprites/blackbishop.png',
-		'q': 'sprites/blackqueen.png',
-		'k': 'sprites/blackking.png',
-		'p': 'sprites/blackpawn.png',
-
-		'R': 'sprites/whiterook.png',
-		'N': 'sprites/whiteknight.png',
-		'B': 'sprites/whitebishop.png',
-		'Q': 'sprites/whitequeen.png',
-		'K': 'sprites/whiteking.png',
-		'P': 'sprites/whitepawn.png'
-	}
-
-	with Image.open(file).copy() as board_image:
-		for i, row in enumerate(board_string_array):
+Theme = collections.namedtuple('Theme', 'light dark border labels')
+
+THEMES = {
+	'classic': Theme('#fff', '#8aa', '#000', '#fff'),
+	'brown': Theme('#f0d9b5', '#b58863', '#312e2b', '#fff'),
+	'grey': Theme('#ddd', '#999', '#000', '#fff'),
+}
+DEFAULT_THEME = 'classic'
+
+# png is truecolour, png8 is palette based, and webp is lossless
+FORMATS = ['png', 'png8', 'webp']
+PALETTE_COLORS = 64
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 6))
+WEBP_METHOD = int(os.environ.get('WEBP_METHOD', 4))
+
+REPLAY_FORMATS = ['gif', 'apng']
+REPLAY_FRAME_MS = 1000
+REPLAY_LAST_FRAME_MS = 3000
+
+# The boards the default size and theme have always been drawn on
+BOARD_IMAGES = {
+	True: 'board_white.png',
+	False: 'board_black.png'
+}
+
+PIECE_IMAGES = {
+	'r': 'sprites/blackrook.png',
+	'n': 'sprites/blackknight.png',
+	'b': 'sprites/blackbishop.png',
+	'q': 'sprites/blackqueen.png',
+	'k': 'sprites/blackking.png',
+	'p': 'sprites/blackpawn.png',
+
+	'R': 'sprites/whiterook.png',
+	'N': 'sprites/whiteknight.png',
+	'B': 'sprites/whitebishop.png',
+	'Q': 'sprites/whitequeen.png',
+	'K': 'sprites/whiteking.png',
+	'P': 'sprites/whitepawn.png'
+}
+
+def expand_placement(placement):
+	'''Turns the placement part of a fen into 8 strings of 8 characters (empty squares are spaces)'''
+	rows = []
+	for row in placement.split('/'):
+		rows.append(''.join(' ' * int(c) if c.isdigit() else c for c in row))
+	if len(rows) != 8 or any(len(row) != 8 for row in rows):
+		raise ValueError(f'Invalid placement: {placement}')
+	return rows
+
+def _load_image(filename, mode):
+	with Image.open(filename) as image:
+		# convert() forces the decode, so nothing is left pointing at the file
+		return image.convert(mode)
+
+
+def border_size(square):
+	return square * BORDER // SQUARE if square >= MIN_LABELLED_SQUARE else 0
+
+def frame_size(square):
+	return 8*square + 2*border_size(square)
+
+def square_for_size(size):
+	'''The biggest square size whose board fits in size pixels (or the smallest there is)'''
+	fitting = [square for square in SQUARE_SIZES if frame_size(square) <= size]
+	return max(fitting) if fitting else min(SQUARE_SIZES)
+
+def _text_size(font, text):
+	if hasattr(font, 'getbbox'):
+		# Newer Pillows dropped getsize
+		left, top, right, bottom = font.getbbox(text)
+		return right, bottom
+	return font.getsize(text)
+
+def make_base_board(iswhite, square=SQUARE, theme=DEFAULT_THEME):
+	'''An empty board, with coordinates around it if there is room for them'''
+	colors = THEMES[theme]
+	border = border_size(square)
+	size = frame_size(square)
+	board_image = Image.new('RGB', (size, size), colors.border)
+	draw = ImageDraw.Draw(board_image)
+	for i in range(8):
+		for j in range(8):
+			x, y = border + square*j, border + square*i
+			# a8 (or h1) is light
+			draw.rectangle((x, y, x + square - 1, y + square - 1), colors.dark if (i+j) % 2 else colors.light)
+
+	if border:
+		font = ImageFont.truetype(LABEL_FONT, border)
+		files = 'ABCDEFGH' if iswhite else 'HGFEDCBA'
+		ranks = '87654321' if iswhite else '12345678'
+		for i in range(8):
+			for text, centers in [(files[i], [(border + square*i + square/2, border/2), (border + square*i + square/2, size - border/2)]),
+					(ranks[i], [(border/2, border + square*i + square/2), (size - border/2, border + square*i + square/2)])]:
+				width, height = _text_size(font, text)
+				for x, y in centers:
+					draw.text((x - width/2, y - height/2), text, font=font, fill=colors.labels)
+	return board_image
+
+def _scale_sprite(sprite, square):
+	if sprite.width == square:
+		return sprite
+	# Scaled with premultiplied alpha, otherwise the transparent pixels bleed into the edges
+	return sprite.convert('RGBa').resize((square, square), Image.LANCZOS).convert('RGBA')
+
+def oriented_rows(placement, iswhite):
+	'''Rows of the placement in the order they are drawn, top to bottom'''
+	rows = expand_placement(placement)
+	if not iswhite:
+		rows = [row[::-1] for row in reversed(rows)]
+	return rows
+
+
+class BoardRenderer:
+	'''Decodes the framed boards and the piece sprites once, then builds every frame from memory.
+
+	Every piece is composited onto a light and a dark square up front, so drawing a square
+	is a plain (opaque) paste of one of 26 tiles. The boards and tiles are also kept quantized
+	to a shared palette, so palette frames are assembled directly without quantizing each one.
+	The last few frames are kept (decoded) so that the next position can be drawn by
+	repainting just the squares that changed.
+
+	Each renderer draws one square size in one theme'''
+	def __init__(self, square=SQUARE, theme=DEFAULT_THEME, piece_images=PIECE_IMAGES, max_frames=32, palette_colors=PALETTE_COLORS):
+		self.square = square
+		self.border = border_size(square)
+		self.theme = theme
+		if (square, theme) == (SQUARE, DEFAULT_THEME):
+			self.boards = {iswhite: _load_image(filename, 'RGB') for iswhite, filename in BOARD_IMAGES.items()}
+		else:
+			self.boards = {iswhite: make_base_board(iswhite, square, theme) for iswhite in [True, False]}
+		self.sprites = {piece: _scale_sprite(_load_image(filename, 'RGBA'), square) for piece, filename in piece_images.items()}
+		self.tiles = self._make_tiles()
+
+		self.palette_boards, self.palette_tiles = self._make_palette_images(palette_colors)
+
+
+		self.max_frames = max_frames
+		self.frames = collections.OrderedDict()		# (placement, iswhite, palette) -> Image
+		self.lock = threading.Lock()
+
+	def _get_frame(self, key):
+		with self.lock:
+			frame = self.frames.get(key)
+			if frame is not None:
+				self.frames.move_to_end(key)
+			return frame
+
+	def _put_frame(self, key, frame):
+		with self.lock:
+			self.frames[key] = frame
+			self.frames.move_to_end(key)
+			while len(self.frames) > self.max_frames:
+				self.frames.popitem(last=False)
+
+	def _make_tiles(self):
+		'''(isdark, piece) -> opaque square image. Empty squares use the piece ' '.
+		The top left square (a8 for white, h1 for black) is light on both boards'''
+		tiles = {}
+		for isdark in [False, True]:
+			x = self.border + self.square*isdark
+			square = self.boards[True].crop((x, self.border, x + self.square, self.border + self.square))
+			tiles[isdark, ' '] = square
+			for piece, sprite in self.sprites.items():
+				tile = square.copy()
+				tile.paste(sprite, (0, 0), sprite)
+				tiles[isdark, piece] = tile
+		return tiles
+
+	def _make_palette_images(self, colors):
+		'''The boards and tiles quantized to one shared palette. They are quantized together
+		as a single image (which doesn't dither), so a colour always maps to the same index'''
+		images = [(self.boards, iswhite) for iswhite in self.boards] + [(self.tiles, key) for key in self.tiles]
+		width = sum(source[key].width for source, key in images)
+		mosaic = Image.new('RGB', (width, max(board.height for board in self.boards.values())))
+		x = 0
+		for source, key in images:
+			mosaic.paste(source[key], (x, 0))
+			x += source[key].width
+		mosaic = mosaic.quantize(colors)
+
+		boards, tiles = {}, {}
+		x = 0
+		for source, key in images:
+			image = source[key]
+			quantized = mosaic.crop((x, 0, x + image.width, image.height))
+			(boards if source is self.boards else tiles)[key] = quantized
+			x += image.width
+		return boards, tiles
+
+	def _paint_square(self, board_image, tiles, i, j, piece):
+		board_image.paste(tiles[(i + j) % 2 == 1, piece], (self.border + self.square*j, self.border + self.square*i))
+
+	def render_full(self, placement, iswhite, palette=False):
+		boards, tiles = (self.palette_boards, self.palette_tiles) if palette else (self.boards, self.tiles)
+		board_image = boards[iswhite].copy()
+		for i, row in enumerate(oriented_rows(placement, iswhite)):
+			for j, piece in enumerate(row):
+				# The base board already has the empty squares
+				if piece != ' ':
+					self._paint_square(board_image, tiles, i, j, piece)
+		return board_image
+
+	def _repaint(self, parent_frame, parent_placement, placement, iswhite, palette):
+		tiles = self.palette_tiles if palette else self.tiles
+		board_image = parent_frame.copy()
+		parent_rows = oriented_rows(parent_placement, iswhite)
+		for i, row in enumerate(oriented_rows(placement, iswhite)):
 			for j, piece in enumerate(row):
-				if piece in piece_image_map:
-					piece_image = Image.open(piece_image_map[piece])
-					board_image.paste(piece_image, (BORDER + 64*j,BORDER + 64*i), piece_image)
+				if piece != parent_rows[i][j]:
+					self._paint_square(board_image, tiles, i, j, piece)
+		return board_image
+
+	def render_from(self, parent_placement, placement, iswhite, palette=False):
+		'''Draws placement by repainting only the squares that differ from parent_placement.
+		Returns None if the parent's frame is no longer around'''
+		parent_frame = self._get_frame((parent_placement, iswhite, palette))
+		if parent_frame is None:
+			return None
+		return self._repaint(parent_frame, parent_placement, placement, iswhite, palette)
+
+	def render_sequence(self, placements, iswhite, palette=False):
+		'''Generates a frame for each placement in a game, each one drawn from the last'''
+		frame = previous = None
+		for placement in placements:
+			if frame is None:
+				frame = self.render_full(placement, iswhite, palette)
+			else:
+				frame = self._repaint(frame, previous, placement, iswhite, palette)
+			previous = placement
+			yield frame
+
+	def render(self, placement, iswhite, parent_placement=None, palette=False):
+		'''The returned frame is shared with the frame cache, so copy it before drawing on it'''
+		key = (placement, iswhite, palette)
+		board_image = self._get_frame(key)
+		if board_image is not None:
+			return board_image
+
+		if parent_placement is not None:
+			board_image = self.render_from(parent_placement, placement, iswhite, palette)
+		if board_image is None:
+			board_image = self.render_full(placement, iswhite, palette)
+
+		self._put_frame(key, board_image)
+		return board_image
+
+
+_renderers = {}		# (square, theme) -> BoardRenderer
+_renderers_lock = threading.Lock()
 
-		# return board_image
-		board_image.save(board_image_name)
\ No newline at end of file
+def get_renderer(square=SQUARE, theme=DEFAULT_THEME):
+	'''One renderer per size and theme per process, each built on first use'''
+	key = (square, theme)
+	renderer = _renderers.get(key)
+	if renderer is None:
+		with _renderers_lock:
+			renderer = _renderers.get(key)
+			if renderer is None:
+				# Only the default board is drawn often enough to be worth keeping many frames of
+				renderer = _renderers[key] = BoardRenderer(square, theme, max_frames=32 if key == (SQUARE, DEFAULT_THEME) else 8)
+	return renderer
+
+MAX_LINKS = 1024
+_parents = collections.OrderedDict()		# placement -> placement it was reached from
+_parents_lock = threading.Lock()
+
+def note_move(parent_placement, placement):
+	'''Lets the next render of placement start from parent_placement's frame
+	(placement was reached from parent_placement by a single move or undo)'''
+	with _parents_lock:
+		_parents[placement] = parent_placement
+		_parents.move_to_end(placement)
+		while len(_parents) > MAX_LINKS:
+			_parents.popitem(last=False)
+
+def parent_of(placement):
+	return _parents.get(placement)
+
+def reset():
+	'''Drops every renderer and move link, along with the locks that guard them. For a freshly
+	forked process, which gets copies of those locks in whatever state they were in, including
+	held by threads that it doesn't have'''
+	global _renderers, _renderers_lock, _parents, _parents_lock
+	_renderers = {}
+	_renderers_lock = threading.Lock()
+	_parents = collections.OrderedDict()
+	_parents_lock = threading.Lock()
+
+def supported_formats():
+	Image.init()
+	return [format for format in FORMATS if format != 'webp' or 'WEBP' in Image.SAVE]
+
+def supported_replay_formats():
+	Image.init()
+	# Older Pillows can only write animated gifs
+	return [format for format in REPLAY_FORMATS if format != 'apng' or 'PNG' in Image.SAVE_ALL]
+
+def encode_image(image, format='png'):
+	buffer = io.BytesIO()
+	if format == 'png':
+		image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+	elif format == 'png8':
+		if image.mode != 'P':
+			image = image.quantize(PALETTE_COLORS)
+		image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+	elif format == 'webp':
+		image.save(buffer, format='WEBP', lossless=True, method=WEBP_METHOD)
+	else:
+		image.save(buffer, format=format.upper())
+	return buffer.getvalue()
+
+def render_board(placement, iswhite, format='png', parent_placement=None, square=SQUARE, theme=DEFAULT_THEME):
+	'''Encoded image bytes for the given placement'''
+	if parent_placement is None:
+		parent_placement = parent_of(placement)
+	board_image = get_renderer(square, theme).render(placement, iswhite, parent_placement, palette=(format == 'png8'))
+	return encode_image(board_image, format)
+
+def render_history(placements, iswhite, format='png'):
+	'''Encoded image bytes for each placement, each one drawn from the last'''
+	frames = get_renderer().render_sequence(placements, iswhite, palette=(format == 'png8'))
+	return [encode_image(frame, format) for frame in frames]
+
+def render_replay(placements, iswhite, format='gif'):
+	'''One animated image (gif or apng) stepping through every placement'''
+	frames = list(get_renderer().render_sequence(placements, iswhite, palette=True))
+	# Linger on the final position
+	durations = [REPLAY_FRAME_MS] * (len(frames) - 1) + [REPLAY_LAST_FRAME_MS]
+	buffer = io.BytesIO()
+	frames[0].save(buffer, format='GIF' if format == 'gif' else 'PNG', save_all=True,
+		append_images=frames[1:], duration=durations, loop=0)
+	return buffer.getvalue()
+
+def create_board_image(fen, iswhite, board_image_name):
+	board_image = get_renderer().render(fen.split()[0], iswhite)
+	board_image.save(board_image_name)
@@ -1,4 +1,5 @@
 import functools
+import hashlib
 import json
 import inspect
 import os
@@ -8,7 +9,7 @@ import sys
 
 import chess
 import chess.pgn
-from flask import Flask, request, send_file, render_template, escape as flask_encode_html
+from flask import Flask, request, send_file, render_template, jsonify, abort, escape as flask_encode_html
 from PIL import Image, ImageDraw
 import requests
 
@@ -16,6 +17,11 @@ import constants
 from constants import WHITE, BLACK, WHITE_WINS, BLACK_WINS, DRAW, MessageType
 import dbactions
 import drawing
+import messagelog
+import renderahead
+import rendercache
+import renderpool
+import svgdrawing
 try:
 	import env
 except ModuleNotFoundError:
@@ -35,23 +41,74 @@ PAGE_ACCESS_TOKEN = os.environ['PAGE_ACCESS_TOKEN']
 
 db = dbactions.DB()
 
+board_cache = rendercache.RenderCache(
+	memory_budget=int(os.environ.get('RENDER_CACHE_MEMORY_BYTES', 32 * 2**20)),
+	# The disk tier is off unless asked for; renders never otherwise touch the disk
+	disk_budget=int(os.environ.get('RENDER_CACHE_DISK_BYTES', 0)),
+	directory=os.environ.get('RENDER_CACHE_DIR', '/tmp/board_cache')
+	)
+
+board_renderer = renderpool.make_renderer(
+	backend=os.environ.get('RENDER_BACKEND', 'inline'),
+	processes=int(os.environ.get('RENDER_PROCESSES', 2)),
+	max_queue=int(os.environ.get('RENDER_QUEUE_SIZE', 16)),
+	timeout=float(os.environ.get('RENDER_TIMEOUT', 5))
+	)
+# Fork the render workers now, while this is the only thread (each gunicorn worker imports us itself)
+if isinstance(board_renderer, renderpool.ProcessPoolRenderer):
+	board_renderer.start()
+
+# What /board serves when the client doesn't ask for anything in particular. Lossless png by default;
+# png8 is under half the size and much quicker to encode, but is quantized to 64 colours
+DEFAULT_IMAGE_FORMAT = os.environ.get('BOARD_IMAGE_FORMAT', 'png')
+
+render_ahead = renderahead.RenderAhead(board_cache, board_renderer, formats=[DEFAULT_IMAGE_FORMAT],
+	workers=int(os.environ.get('RENDER_AHEAD_WORKERS', 2)))
+db.board_listeners.append(render_ahead.submit)
+
+# Looks db up on every write, since the tests swap it out
+message_log = messagelog.MessageLogWriter(lambda entries: db.log_messages(entries),
+	max_batch=int(os.environ.get('MESSAGE_LOG_BATCH', 100)),
+	flush_interval=float(os.environ.get('MESSAGE_LOG_INTERVAL', 1)),
+	max_queue=int(os.environ.get('MESSAGE_LOG_QUEUE', 10000)))
+
+# Browsers can all draw svg, which is cheaper to make and to send than any raster format
+EXPLORE_SVG = os.environ.get('EXPLORE_SVG', '1') == '1'
+
 app = Flask(__name__)
 
 @app.route('/image/<fen>', methods=['GET'])
 def board_image(fen):
-	board_image_name = f'/tmp/{fen}.png'
-	fen = fen.replace('-', '/')  + ' w - - 0 1'
-	# board = chess.Board(fen)
-	board = dbactions.ChessBoard(fen)
-	board_string_array = str(board).replace(' ', '').split('\n')
-	board_image = create_board_image(board_string_array)
-	board_image.save(board_image_name)
-	return send_file(board_image_name)
+	placement = fen.replace('-', '/')
+	key = rendercache.CacheKey(placement, 'w', 'png', 512)
+	def render():
+		board_string_array = drawing.expand_placement(placement)
+		return drawing.encode_image(create_board_image(board_string_array))
+	return cached_image_response(board_cache.get_or_render(key, render))
 
 @app.route('/sprites/<img>', methods=['GET'])
 def sprites(img):
 	return send_file('sprites/' + img)
 
+@app.route('/board/<fen>.svg', methods=['GET'])
+def board_svg(fen):
+	perspective_iswhite = (request.args.get('perspective') or 'w')[0].lower() == 'w'
+	placement = fen.replace('-', '/')
+	# svg scales itself, so only the theme matters
+	_, theme = board_style()
+
+	# Drawing it is just string formatting, so no need for the render pool
+	key = rendercache.board_key(placement, perspective_iswhite, 'svg', theme=theme)
+	image = board_cache.get_or_render(key, lambda: svgdrawing.render_board(placement, perspective_iswhite, theme=theme))
+	if 'gzip' in request.accept_encodings:
+		image = board_cache.get_or_render(key._replace(format='svgz'), lambda: svgdrawing.compress(image.data))
+		response = cached_image_response(image)
+		response.content_encoding = 'gzip'
+	else:
+		response = cached_image_response(image)
+	response.vary.add('Accept-Encoding')
+	return response
+
 @app.route('/board/<fen>', methods=['GET'])
 def board_imageII(fen):
 	# perspective = BLACK if request.args.get('perspective') == 'b' else WHITE
@@ -62,17 +119,63 @@ def board_imageII(fen):
 
 	# print(fen, perspective_iswhite)
 	fen = fen.split('?')[0] # don't know if it includes the query characters...
-	board_image_name = f'/tmp/{fen}_{perspective_arg}.png'
-
-	fen = fen.replace('-', '/')  + ' w - - 0 1'
-
-	drawing.create_board_image(fen, perspective_iswhite, board_image_name)
+	placement = fen.replace('-', '/')
+
+	image_format, negotiated = negotiate_image_format()
+	square, theme = board_style()
+
+	key = rendercache.board_key(placement, perspective_iswhite, image_format, drawing.frame_size(square), theme)
+	# If this position is being rendered ahead right now, just wait for that
+	render_ahead.wait(key)
+	image = board_cache.get_or_render(key, lambda: board_renderer.render(placement, perspective_iswhite, image_format, square, theme))
+	response = cached_image_response(image)
+	if negotiated:
+		response.vary.add('Accept')
+	return response
+
+def board_style():
+	'''Square size and theme from ?size= (the most pixels wide the client wants) and ?theme='''
+	try:
+		square = drawing.square_for_size(int(request.args.get('size')))
+	except (TypeError, ValueError):
+		square = drawing.SQUARE
+	theme = request.args.get('theme')
+	if theme not in drawing.THEMES:
+		theme = drawing.DEFAULT_THEME
+	return square, theme
+
+def negotiate_image_format():
+	'''Returns the format, and whether it depended on the Accept header.
+	An explicit ?format= wins, then webp if the client says it takes it'''
+	formats = drawing.supported_formats()
+	requested = (request.args.get('format') or '').lower()
+	if requested in formats:
+		return requested, False
+	if 'webp' in formats and 'image/webp' in request.accept_mimetypes.values():
+		return 'webp', True
+	return DEFAULT_IMAGE_FORMAT, True
+
+# A board url always renders the same image, so clients may hang on to it
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 7 * 86400))
+
+def cached_image_response(image, max_age=IMAGE_MAX_AGE):
+	'''Sends the encoded image straight from memory. With max_age=0, clients check back
+	(by ETag) every time, for urls whose image changes'''
+	response = app.response_class(image.data, mimetype=image.mimetype)
+	response.content_length = len(image.data)
+	response.set_etag(image.etag)
+	response.last_modified = image.last_modified
+	response.cache_control.public = True
+	if max_age:
+		response.cache_control.max_age = max_age
+	else:
+		response.cache_control.no_cache = True
+	# Turns it into a 304 if the client already has it
+	return response.make_conditional(request)
 
-	# board = chess.Board(fen)
-	
-	# board_image = create_board_image(board_string_array)
-	# board_image.save(board_image_name)
-	return send_file(board_image_name)
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+	return jsonify(cache=board_cache.stats(), renderer=board_renderer.stats(), db=db.pool.stats(), message_log=message_log.stats())
 
 # def format_reminders(reminders):
 
@@ -110,14 +213,53 @@ def send_reminders():
 	# 	raise Exception('Still spamming people....')
 
 
-@app.route('/pgn/<game_id>', methods=['GET'])
+@app.route('/replay/<int:game_id>', methods=['GET'])
+@app.route('/replay/<int:game_id>.<extension>', methods=['GET'])		# Allow e.g. /replay/12.gif
+def replay(game_id, extension=None):
+	'''The whole game as one animated image'''
+	perspective_iswhite = (request.args.get('perspective') or 'w')[0].lower() == 'w'
+	requested = (request.args.get('format') or '').lower()
+	image_format = requested if requested in drawing.supported_replay_formats() else 'gif'
+
+	history = db.game_history(game_id)
+	if history is None:
+		abort(404)
+	# An undo then a different move keeps the ply count, so the moves themselves tell versions apart
+	moves = ' '.join(entry.move.uci() for entry in history[1:])
+	digest = hashlib.sha1(f'{history[0].fen} {moves}'.encode('utf-8')).hexdigest()
+	key = rendercache.CacheKey(f'replay:{game_id}:{digest}',
+		'w' if perspective_iswhite else 'b', image_format, drawing.FRAME_SIZE)
+
+	def render():
+		return board_renderer.render_replay([entry.placement for entry in history], perspective_iswhite, image_format)
+
+	# The same url gets a new replay with every move
+	return cached_image_response(board_cache.get_or_render(key, render), max_age=0)
+
+
+def history_pgn(history):
+	'''The game as pgn text, straight from its history rather than from a decoded board'''
+	start_fen = history[0].fen
+	pgn = chess.pgn.Game()
+	if start_fen != chess.STARTING_FEN:
+		pgn.setup(dbactions.ChessBoard(start_fen))
+	node = pgn
+	for entry in history[1:]:
+		node = node.add_variation(entry.move)
+	pgn.headers['Result'] = dbactions.ChessBoard(history[-1].fen).result()
+
+	exporter = chess.pgn.StringExporter()
+	pgn.accept(exporter)
+	return str(exporter)
+
+
+@app.route('/pgn/<int:game_id>', methods=['GET'])
+@app.route('/pgn/<int:game_id>.pgn', methods=['GET'])
 def board_pgn(game_id):
-	board = db.board_from_id(game_id.strip('.pgn'))
-	pgn = chess.pgn.Game.from_board(board)
-	with open(game_id, 'w') as f:
-		exporter = chess.pgn.FileExporter(f)
-		pgn.accept(exporter)
-	return send_file(game_id)
+	history = db.game_history(game_id)
+	if history is None:
+		abort(404)
+	return app.response_class(history_pgn(history), mimetype='application/x-chess-pgn')
 
 
 @app.route('/', methods=['GET'])
@@ -141,8 +283,16 @@ def explore(game_id):
 		return 'Success!'
 
 	else:
-		board = db.board_from_id(game_id)
-		imgurls = board.get_img_urls()
+		history = db.game_history(game_id)
+		if history is None:
+			abort(404)
+		if EXPLORE_SVG:
+			imgurls = dbactions.history_img_urls(history, '.svg')
+		else:
+			imgurls = dbactions.history_img_urls(history)
+			# The page is about to ask for every one of these, so render them all in one go
+			image_format, _ = negotiate_image_format()
+			render_ahead.submit_history([entry.placement for entry in history], True, image_format)
 
 		return render_template('explore.html',
 			imgurls=imgurls,
@@ -200,7 +350,7 @@ def messages():
 	try:
 		for sender, message in messaging_events(request.get_data()):
 			sender, message = int(sender), message.strip()
-			db.log_message(message, MessageType.PLAYER_MESSAGE, senderid=sender)
+			message_log.log(message, MessageType.PLAYER_MESSAGE, senderid=sender)
 			handle_message(sender, message)
 	except Exception as e:
 		print('Error handling messages:', repr(e))
@@ -354,9 +504,13 @@ def almosthelp(sender):
 def undo(player, opponent, game):
 	if game.undo:
 		if game.is_active_player(player.id):
+			previous_placement = game.board.board_fen()
 			game.board.pop()
-			db.set_undo_flag(game, False)
-			db.save_game(game)
+			drawing.note_move(previous_placement, game.board.board_fen())
+			# Drops the move and clears the undo request all at once
+			if not db.pop_move(game, player.id):
+				send_message(player.id, 'The game changed while you were undoing. Please try again')
+				return
 			send_message(opponent.id, f'{player.nickname} accepted your undo request')
 			send_game_rep(player.id, game, player.color)
 			send_game_rep(opponent.id, game, opponent.color)
@@ -663,21 +817,33 @@ def handle_move(sender, message):
 			send_message(player.id, 'That is an invalid move')
 		return
 
+	previous_placement = game.board.board_fen()
 	game.board.push_san(move)
-	db.save_game(game)
-	db.set_undo_flag(game, False)
+	drawing.note_move(previous_placement, game.board.board_fen())
+
+	checkmate = game.board.is_checkmate()
+	draw_reason = None if checkmate else game.draw_reason()
+	if checkmate:
+		outcome = WHITE_WINS if sender == game.whiteplayer.id else BLACK_WINS
+	elif draw_reason:
+		outcome = DRAW
+	else:
+		outcome = None
+	# Saves the move, the cleared undo flag and the outcome all at once
+	if not db.apply_move(game, player.id, outcome):
+		send_message(sender, 'The game changed while you were moving. Please try again')
+		return
 
 	send_game_rep(player.id, game, player.color)
 	send_message(opponent.id, f'{player.nickname} played {move}')
 	send_game_rep(opponent.id, game, opponent.color)
 
-	opponentid = game.blackplayer.id if game.whiteplayer.id == sender else game.whiteplayer.id
-
-	if game.board.is_checkmate():
-		outcome = WHITE_WINS if sender == game.whiteplayer.id else BLACK_WINS
-		db.set_outcome(game, outcome)
+	if checkmate:
 		send_message(player.id, f'Checkmate! {player.nickname} wins!')
 		send_message(opponent.id, f'Checkmate! {player.nickname} wins!')
+	elif draw_reason:
+		send_message(player.id, f'{draw_reason}. The game is a draw')
+		send_message(opponent.id, f'{draw_reason}. The game is a draw')
 	elif game.board.is_check():
 		send_message(player.id, 'Check!')
 		send_message(opponent.id, 'Check!')
@@ -723,7 +889,7 @@ def send_pgn(recipient, gameid):
 
 def send_game_rep(recipient, game, perspective=WHITE):
 	board_image_url = game.image_url(perspective)
-	db.log_message(board_image_url, MessageType.CHESSBOT_IMAGE, recipientid=recipient)
+	message_log.log(board_image_url, MessageType.CHESSBOT_IMAGE, recipientid=recipient)
 	r = requests.post('https://graph.facebook.com/v2.9/me/messages',
 		params={'access_token': PAGE_ACCESS_TOKEN},
 		data=json.dumps({
@@ -751,7 +917,7 @@ def show_game_to_both(game):
 def send_message(recipient, text):
 	# Leave in the print for good measure
 	print('sending message: ', recipient, text)
-	db.log_message(text, MessageType.CHESSBOT_TEXT, recipientid=recipient)
+	message_log.log(text, MessageType.CHESSBOT_TEXT, recipientid=recipient)
 	r = requests.post('https://graph.facebook.com/v2.9/me/messages',
 		params={'access_token': PAGE_ACCESS_TOKEN},
 		data=json.dumps({
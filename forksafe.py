@@ -0,0 +1,34 @@
+import os
+import threading
+
+# Held while something starts up in a new process
+_starting = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+	def _reset_starting():
+		global _starting
+		_starting = threading.Lock()
+	os.register_at_fork(after_in_child=_reset_starting)
+
+class ForkSafe:
+	'''Something whose lock, threads or connections belong to one process. _start sets those up
+	(with a new self.lock held) the first time _ensure_started is called in each process'''
+	_pid = None
+
+	def _start(self):
+		raise NotImplementedError
+
+	def _started(self):
+		return self._pid == os.getpid()
+
+	def _ensure_started(self):
+		'''Returns True if this call did the starting'''
+		if self._started():
+			return False
+		with _starting:
+			if self._started():
+				return False
+			self.lock = threading.Lock()
+			with self.lock:
+				self._start()
+			self._pid = os.getpid()
+			return True
@@ -0,0 +1,109 @@
+import atexit
+import queue
+import threading
+import time
+
+import forksafe
+
+class MessageLogWriter(forksafe.ForkSafe):
+	'''Writes message log entries from a background thread, many rows per insert, so that
+	logging doesn't add a round trip to the database for every message sent or received.
+
+	A batch is written once it has max_batch entries, or once its oldest entry is flush_interval
+	seconds old. At most max_queue entries wait at once. Past that, log() waits up to put_timeout
+	seconds for room, and then writes its entry itself rather than lose it.
+
+	write is called with a list of (message, message_type, senderid, recipientid)'''
+	def __init__(self, write, max_batch=100, flush_interval=1.0, max_queue=10000, put_timeout=1.0):
+		self.write = write
+		self.max_batch = max_batch
+		self.flush_interval = flush_interval
+		self.max_queue = max_queue
+		self.put_timeout = put_timeout
+		self.queue = None
+		self.thread = None
+
+		self.written = 0
+		self.batches = 0
+		self.overflows = 0
+		self.dropped = 0
+		atexit.register(self.close)
+
+	def _start(self):
+		self.queue = queue.Queue(self.max_queue)
+		self.thread = threading.Thread(target=self._run, args=(self.queue,), name='message-log', daemon=True)
+		self.thread.start()
+
+	def log(self, message, message_type, *, senderid=None, recipientid=None):
+		entry = (message, message_type, senderid, recipientid)
+		self._ensure_started()
+		try:
+			self.queue.put(entry, timeout=self.put_timeout)
+		except queue.Full:
+			self.overflows += 1
+			self._write([entry])
+
+	def _run(self, entries):
+		while True:
+			entry = entries.get()
+			if entry is None:
+				entries.task_done()
+				return
+			batch = [entry]
+			deadline = time.monotonic() + self.flush_interval
+			stop = False
+			while len(batch) < self.max_batch:
+				try:
+					entry = entries.get(timeout=max(0, deadline - time.monotonic()))
+				except queue.Empty:
+					break
+				if entry is None:
+					stop = True
+					break
+				batch.append(entry)
+			self._write(batch)
+			for _ in range(len(batch) + stop):
+				entries.task_done()
+			if stop:
+				return
+
+	def _write(self, batch):
+		try:
+			self.write(batch)
+		except Exception as e:
+			# Never let logging get in the way of anything else
+			print('Error while writing the message log:', repr(e))
+			self.dropped += len(batch)
+		else:
+			self.written += len(batch)
+			self.batches += 1
+
+	def flush(self):
+		'''Blocks until everything logged so far has been written'''
+		if self._started():
+			self.queue.join()
+
+	def close(self, timeout=5):
+		'''Writes what's left and stops the thread. Called at exit'''
+		if not self._started():
+			return
+		with self.lock:
+			if not self._started() or not self.thread.is_alive():
+				return
+			entries, thread = self.queue, self.thread
+			# Anything logged after this starts a new thread
+			self._pid = None
+		try:
+			entries.put(None, timeout=timeout)
+		except queue.Full:
+			return
+		thread.join(timeout)
+
+	def stats(self):
+		return {
+			'queued': self.queue.qsize() if self._started() else 0,
+			'written': self.written,
+			'batches': self.batches,
+			'overflows': self.overflows,
+			'dropped': self.dropped,
+		}
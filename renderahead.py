@@ -0,0 +1,79 @@
+import concurrent.futures
+
+import forksafe
+import rendercache
+
+class RenderAhead(forksafe.ForkSafe):
+	'''Renders both perspectives of a freshly saved position in the background,
+	so that by the time Messenger fetches the image it is already in the cache'''
+	def __init__(self, cache, renderer, formats=('png',), workers=2):
+		self.cache = cache
+		self.renderer = renderer
+		self.formats = formats
+		self.workers = workers
+		self.in_flight = {}			# CacheKey -> Future
+
+	def _start(self):
+		# What a parent had in flight will never finish here
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+		self.in_flight = {}
+
+	def submit(self, board):
+		if self.workers <= 0:
+			return
+		self._ensure_started()
+		placement = board.board_fen()
+		for image_format in self.formats:
+			for iswhite in [True, False]:
+				key = rendercache.board_key(placement, iswhite, image_format)
+				with self.lock:
+					if key in self.in_flight or key in self.cache:
+						continue
+					future = self.pool.submit(self._render, key, placement, iswhite)
+					self.in_flight[key] = future
+
+	def submit_history(self, placements, iswhite, image_format):
+		'''Renders every position of a game that isn't cached yet, as one job, each drawn from the last'''
+		if self.workers <= 0:
+			return
+		self._ensure_started()
+		keys = {}
+		with self.lock:
+			for placement in placements:
+				key = rendercache.board_key(placement, iswhite, image_format)
+				if key not in keys and key not in self.in_flight and key not in self.cache:
+					keys[key] = placement
+			if not keys:
+				return
+			future = self.pool.submit(self._render_history, list(keys), list(keys.values()), iswhite)
+			for key in keys:
+				self.in_flight[key] = future
+
+	def _render_history(self, keys, placements, iswhite):
+		try:
+			images = self.renderer.render_history(placements, iswhite, keys[0].format)
+			for key, data in zip(keys, images):
+				self.cache.put(key, data)
+		except Exception as e:
+			print('Error while rendering history ahead:', repr(e))
+		finally:
+			with self.lock:
+				for key in keys:
+					self.in_flight.pop(key, None)
+
+	def _render(self, key, placement, iswhite):
+		try:
+			self.cache.put(key, self.renderer.render(placement, iswhite, key.format))
+		except Exception as e:
+			print('Error while rendering ahead:', repr(e))
+		finally:
+			with self.lock:
+				self.in_flight.pop(key, None)
+
+	def wait(self, key, timeout=5):
+		'''Blocks until key is done rendering, if it is being rendered right now'''
+		if not self._started():
+			return
+		future = self.in_flight.get(key)
+		if future is not None:
+			concurrent.futures.wait([future], timeout=timeout)
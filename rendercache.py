@@ -0,0 +1,214 @@
+import collections
+import datetime
+import hashlib
+import os
+import threading
+
+import drawing
+
+# size is the pixel width of the whole frame, so differently scaled boards never collide
+CacheKey = collections.namedtuple('CacheKey', 'placement perspective format size theme')
+CacheKey.__new__.__defaults__ = (drawing.DEFAULT_THEME,)
+
+CachedImage = collections.namedtuple('CachedImage', 'data mimetype etag last_modified')
+
+MIMETYPES = {
+	'png': 'image/png',
+	'png8': 'image/png',
+	'gif': 'image/gif',
+	'apng': 'image/png',
+	'webp': 'image/webp',
+	'svg': 'image/svg+xml',
+	'svgz': 'image/svg+xml',		# gzipped, served with Content-Encoding: gzip
+}
+
+def board_key(placement, iswhite, format='png', size=None, theme=drawing.DEFAULT_THEME):
+	if size is None:
+		size = drawing.FRAME_SIZE
+	return CacheKey(placement, 'w' if iswhite else 'b', format, size, theme)
+
+def key_digest(key):
+	return hashlib.sha1(repr(tuple(key)).encode('utf-8')).hexdigest()
+
+def make_entry(key, data, last_modified=None):
+	if last_modified is None:
+		last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+	return CachedImage(
+		data,
+		MIMETYPES.get(key.format, 'application/octet-stream'),
+		hashlib.sha1(data).hexdigest(),
+		last_modified
+		)
+
+
+class MemoryTier:
+	'''LRU of encoded images, bounded by the total number of bytes held'''
+	def __init__(self, budget):
+		self.budget = budget
+		self.size = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+			return entry
+
+	def put(self, key, entry):
+		if len(entry.data) > self.budget:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= len(old.data)
+			self.entries[key] = entry
+			self.size += len(entry.data)
+			while self.size > self.budget:
+				_, evicted = self.entries.popitem(last=False)
+				self.size -= len(evicted.data)
+
+
+class DiskTier:
+	'''LRU of encoded images in a directory, bounded by the total size of the files.
+	Files are named after the key digest, so the tier survives restarts of the process
+	(in the order they were written, since reads only reorder the in-memory index)'''
+	def __init__(self, directory, budget):
+		self.directory = directory
+		self.budget = budget
+		self.size = 0
+		self.entries = collections.OrderedDict()		# filename -> file size
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+		self._scan()
+
+	def _scan(self):
+		files = []
+		for filename in os.listdir(self.directory):
+			path = os.path.join(self.directory, filename)
+			if filename.endswith('.tmp') or not os.path.isfile(path):
+				continue
+			stat = os.stat(path)
+			files.append((stat.st_mtime, filename, stat.st_size))
+		for _, filename, size in sorted(files):
+			self.entries[filename] = size
+			self.size += size
+		self._evict()
+
+	def _filename(self, key):
+		return f'{key_digest(key)}.{key.format}'
+
+	def contains(self, key):
+		with self.lock:
+			return self._filename(key) in self.entries
+
+	def get(self, key):
+		filename = self._filename(key)
+		with self.lock:
+			if filename not in self.entries:
+				return None
+			self.entries.move_to_end(filename)
+		path = os.path.join(self.directory, filename)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+				# When it was rendered, so that it's the same however many times it comes back from disk
+				modified = os.fstat(f.fileno()).st_mtime
+		except OSError:
+			# Somebody else cleaned up /tmp from under us
+			with self.lock:
+				self.size -= self.entries.pop(filename, 0)
+			return None
+		return make_entry(key, data, datetime.datetime.utcfromtimestamp(int(modified)))
+
+	def put(self, key, entry):
+		if len(entry.data) > self.budget:
+			return
+		filename = self._filename(key)
+		path = os.path.join(self.directory, filename)
+		tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+		try:
+			with open(tmp_path, 'wb') as f:
+				f.write(entry.data)
+			os.replace(tmp_path, path)
+		except OSError as e:
+			print('Could not write to the render cache:', repr(e))
+			return
+		with self.lock:
+			self.size -= self.entries.pop(filename, 0)
+			self.entries[filename] = len(entry.data)
+			self.size += len(entry.data)
+			self._evict()
+
+	def _evict(self):
+		while self.size > self.budget and self.entries:
+			filename, size = self.entries.popitem(last=False)
+			self.size -= size
+			try:
+				os.remove(os.path.join(self.directory, filename))
+			except OSError:
+				pass
+
+
+class RenderCache:
+	'''Two tier (memory, then disk) cache of rendered board images'''
+	def __init__(self, memory_budget, disk_budget=0, directory=None):
+		self.memory = MemoryTier(memory_budget)
+		if directory and disk_budget:
+			self.disk = DiskTier(directory, disk_budget)
+		else:
+			self.disk = None
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()		# Just for the counters
+
+	def __contains__(self, key):
+		'''Like get, but doesn't count towards the hit/miss stats'''
+		if self.memory.get(key) is not None:
+			return True
+		return self.disk is not None and self.disk.contains(key)
+
+	def get(self, key):
+		entry = self.memory.get(key)
+		from_disk = False
+		if entry is None and self.disk is not None:
+			entry = self.disk.get(key)
+			if entry is not None:
+				from_disk = True
+				self.memory.put(key, entry)
+		with self.lock:
+			if entry is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.disk_hits += from_disk
+		return entry
+
+	def put(self, key, data):
+		entry = make_entry(key, data)
+		self.memory.put(key, entry)
+		if self.disk is not None:
+			self.disk.put(key, entry)
+		return entry
+
+	def get_or_render(self, key, render):
+		'''render is only called on a miss, and must return the encoded image bytes'''
+		entry = self.get(key)
+		if entry is None:
+			entry = self.put(key, render())
+		return entry
+
+	def stats(self):
+		with self.lock:
+			hits, disk_hits, misses = self.hits, self.disk_hits, self.misses
+		return {
+			'hits': hits,
+			'disk_hits': disk_hits,
+			'misses': misses,
+			'memory_entries': len(self.memory.entries),
+			'memory_bytes': self.memory.size,
+			'disk_entries': len(self.disk.entries) if self.disk else 0,
+			'disk_bytes': self.disk.size if self.disk else 0,
+		}
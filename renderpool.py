@@ -0,0 +1,135 @@
+import concurrent.futures
+import concurrent.futures.process
+import os
+import threading
+
+import drawing
+import forksafe
+
+class InlineRenderer:
+	'''Renders in the calling thread'''
+	def render(self, placement, iswhite, format='png', square=drawing.SQUARE, theme=drawing.DEFAULT_THEME):
+		return drawing.render_board(placement, iswhite, format, square=square, theme=theme)
+
+	def render_history(self, placements, iswhite, format='png'):
+		return drawing.render_history(placements, iswhite, format)
+
+	def render_replay(self, placements, iswhite, format='gif'):
+		return drawing.render_replay(placements, iswhite, format)
+
+	def stats(self):
+		return {'backend': 'inline'}
+
+
+_worker_pid = None
+
+def _in_worker(func, *args):
+	'''Runs func in a pool worker. The pool may have been forked while other threads were
+	rendering, so the first job in each worker starts from a clean slate'''
+	global _worker_pid
+	if _worker_pid != os.getpid():
+		drawing.reset()
+		_worker_pid = os.getpid()
+	return func(*args)
+
+
+class ProcessPoolRenderer(forksafe.ForkSafe):
+	'''Renders in a pool of worker processes, so PIL work doesn't hold the web worker's GIL.
+
+	At most max_queue renders may be queued or running at once. Anything past that, or anything
+	that takes longer than timeout seconds, or anything the pool can't handle, is rendered inline'''
+	def __init__(self, processes=2, max_queue=16, timeout=5):
+		self.processes = processes
+		self.timeout = timeout
+		self.max_queue = max_queue
+		self.inline = InlineRenderer()
+		self.rendered = 0
+		self.fallbacks = 0
+
+	def _start(self):
+		# Neither a parent's pool nor the slots its renders hold are any use here
+		self.slots = threading.BoundedSemaphore(self.max_queue)
+		self.pool = None
+
+	def _get_pool(self):
+		with self.lock:
+			if self.pool is None:
+				self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+			return self.pool
+
+	def start(self):
+		'''Starts the worker processes now. Call it before starting any threads, so that the
+		workers aren't forked while another thread holds a lock'''
+		self._ensure_started()
+		self._get_pool().submit(os.getpid).result()
+
+	def _reset_pool(self, pool):
+		with self.lock:
+			if self.pool is pool:
+				self.pool = None
+		pool.shutdown(wait=False)
+
+	def render(self, placement, iswhite, format='png', square=drawing.SQUARE, theme=drawing.DEFAULT_THEME):
+		# The worker processes don't see our note_move calls, so pass the lineage along
+		parent_placement = drawing.parent_of(placement)
+		return self._run(self.inline.render, drawing.render_board, placement, iswhite, format, parent_placement, square, theme,
+			fallback_args=(placement, iswhite, format, square, theme))
+
+	def render_history(self, placements, iswhite, format='png'):
+		return self._run(self.inline.render_history, drawing.render_history, list(placements), iswhite, format)
+
+	def render_replay(self, placements, iswhite, format='gif'):
+		return self._run(self.inline.render_replay, drawing.render_replay, list(placements), iswhite, format)
+
+	def _run(self, fallback, func, *args, fallback_args=None):
+		if fallback_args is None:
+			fallback_args = args
+		self._ensure_started()
+		if not self.slots.acquire(blocking=False):
+			self.fallbacks += 1
+			return fallback(*fallback_args)
+
+		pool = None
+		try:
+			pool = self._get_pool()
+			future = pool.submit(_in_worker, func, *args)
+		except (RuntimeError, concurrent.futures.process.BrokenProcessPool) as e:
+			self.slots.release()
+			print('Render pool unavailable:', repr(e))
+			if pool is not None:
+				self._reset_pool(pool)
+			self.fallbacks += 1
+			return fallback(*fallback_args)
+
+		# Hold the slot until the worker is actually done, even if we stop waiting for it
+		future.add_done_callback(lambda _: self.slots.release())
+		try:
+			data = future.result(timeout=self.timeout)
+		except concurrent.futures.TimeoutError:
+			print('Render timed out, rendering inline')
+		except concurrent.futures.process.BrokenProcessPool as e:
+			print('Render pool broke:', repr(e))
+			self._reset_pool(pool)
+		else:
+			self.rendered += 1
+			return data
+
+		self.fallbacks += 1
+		return fallback(*fallback_args)
+
+	def stats(self):
+		return {
+			'backend': 'process',
+			'processes': self.processes,
+			'rendered': self.rendered,
+			'fallbacks': self.fallbacks,
+		}
+
+
+def make_renderer(backend='inline', processes=2, max_queue=16, timeout=5):
+	if backend == 'process':
+		return ProcessPoolRenderer(processes, max_queue, timeout)
+	elif backend == 'inline':
+		return InlineRenderer()
+	else:
+		raise ValueError(f'Unknown render backend {backend}')
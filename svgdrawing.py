@@ -0,0 +1,115 @@
+import gzip
+import io
+import os
+import re
+
+import drawing
+
+LABEL_FONT = 'Arial, Helvetica, sans-serif'
+LABEL_SIZE = 24
+
+FILES = 'ABCDEFGH'
+
+SVG_TEMPLATE = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+	'version="1.1" width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+	'<defs>{defs}</defs>{board}{pieces}</svg>')
+SYMBOL_TEMPLATE = '<symbol id="{id}" viewBox="0 0 {square} {square}">{body}</symbol>'
+SQUARE_TEMPLATE = '<rect x="{x}" y="{y}" width="{square}" height="{square}" fill="{fill}"/>'
+LABEL_TEMPLATE = '<text x="{x}" y="{y}" text-anchor="middle" dominant-baseline="central">{text}</text>'
+PIECE_TEMPLATE = '<use xlink:href="#{id}" x="{x}" y="{y}" width="{square}" height="{square}"/>'
+
+def _sprite_id(piece):
+	return os.path.splitext(os.path.basename(drawing.PIECE_IMAGES[piece]))[0]
+
+def _load_sprite(piece):
+	'''The insides of the piece's svg, wrapped up as a symbol to <use>'''
+	filename = os.path.splitext(drawing.PIECE_IMAGES[piece])[0] + '.svg'
+	with open(filename) as f:
+		svg = f.read()
+	start = svg.index('>', svg.index('<svg')) + 1
+	end = svg.rindex('</svg>')
+	return SYMBOL_TEMPLATE.format(id=_sprite_id(piece), square=drawing.SQUARE, body=_minify(svg[start:end]))
+
+def _minify(svg):
+	'''The sprites come straight out of an editor. Hundredths of a unit are plenty at 64px,
+	and the rest is whitespace and attributes that only restate the defaults'''
+	svg = re.sub(r'(\.\d{2})\d+', r'\1', svg)
+	svg = re.sub(r'>\s+<', '><', svg)
+	svg = re.sub(r' stroke-(dasharray="none"|miterlimit="4")', '', svg)
+	return svg.strip()
+
+def _board(iswhite, labels, theme):
+	'''Everything that doesn't depend on the position: background, squares and coordinates'''
+	colors = drawing.THEMES[theme]
+	border, square = drawing.BORDER, drawing.SQUARE
+	parts = [f'<rect width="{drawing.FRAME_SIZE}" height="{drawing.FRAME_SIZE}" fill="{colors.border}"/>',
+		f'<rect x="{border}" y="{border}" width="{8*square}" height="{8*square}" fill="{colors.light}"/>']
+	for i in range(8):
+		for j in range(8):
+			if (i+j) % 2:
+				parts.append(SQUARE_TEMPLATE.format(x=border + square*j, y=border + square*i, square=square, fill=colors.dark))
+
+	if labels:
+		files = FILES if iswhite else FILES[::-1]
+		ranks = '87654321' if iswhite else '12345678'
+		parts.append(f'<g fill="{colors.labels}" font-family="{LABEL_FONT}" font-size="{LABEL_SIZE}">')
+		for i in range(8):
+			middle = border + square*i + square/2
+			for edge in [border/2, border + 8*square + border/2]:
+				parts.append(LABEL_TEMPLATE.format(x=middle, y=edge, text=files[i]))
+				parts.append(LABEL_TEMPLATE.format(x=edge, y=middle, text=ranks[i]))
+		parts.append('</g>')
+	return ''.join(parts)
+
+
+class SVGRenderer:
+	'''Builds boards out of sprites/*.svg. The sprites are read once, and each one
+	goes into a board once as a symbol no matter how many of that piece are on it'''
+	def __init__(self):
+		self.symbols = {piece: _load_sprite(piece) for piece in drawing.PIECE_IMAGES}
+		self.boards = {}			# (iswhite, labels, theme) -> svg
+
+	def _get_board(self, iswhite, labels, theme):
+		key = (iswhite, labels, theme)
+		board = self.boards.get(key)
+		if board is None:
+			# Two threads might both build it, which is harmless
+			board = self.boards[key] = _board(iswhite, labels, theme)
+		return board
+
+	def render(self, placement, iswhite, labels=True, theme=drawing.DEFAULT_THEME):
+		'''The board as svg text'''
+		border, square = drawing.BORDER, drawing.SQUARE
+		used = set()
+		pieces = []
+		for i, row in enumerate(drawing.oriented_rows(placement, iswhite)):
+			for j, piece in enumerate(row):
+				if piece in self.symbols:
+					used.add(piece)
+					pieces.append(PIECE_TEMPLATE.format(id=_sprite_id(piece), x=border + square*j, y=border + square*i, square=square))
+		return SVG_TEMPLATE.format(
+			size=drawing.FRAME_SIZE,
+			defs=''.join(self.symbols[piece] for piece in sorted(used)),
+			board=self._get_board(iswhite, labels, theme),
+			pieces=''.join(pieces))
+
+
+_renderer = None
+
+def get_renderer():
+	'''One renderer per process, built on first use'''
+	global _renderer
+	if _renderer is None:
+		_renderer = SVGRenderer()
+	return _renderer
+
+def render_board(placement, iswhite, labels=True, theme=drawing.DEFAULT_THEME):
+	'''The board as utf-8 encoded svg, ready to be cached and served'''
+	return get_renderer().render(placement, iswhite, labels, theme).encode('utf-8')
+
+def compress(data):
+	'''gzip, but without a timestamp so that every process produces the same bytes (and etag)'''
+	buffer = io.BytesIO()
+	with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+		f.write(data)
+	return buffer.getvalue()
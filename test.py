@@ -4,14 +4,22 @@ if not sys.flags.debug:
 
 from collections import defaultdict
 import datetime
+import os
+import tempfile
 import time
 import unittest
 
 import chess
 import psycopg2
+import psycopg2.pool
 
+import bulkboards
 import constants
 import dbactions
+import dbpool
+import drawing
+import messagelog
+import rendercache
 from dbtools import refresh_funcs
 import fbchessbot
 
@@ -762,9 +770,36 @@ class TestGameFinish(GamePlayTest):
 		self.handle_message(chadid, 'resign', expected_replies=1)
 		self.assertLastMessageEquals(chadid, 'You have no active games')
 
-	@unittest.skip
-	def test_draw(self):
-		pass
+	def assertDrawn(self, reason, mover, move):
+		opponent = jessid if mover == nateid else nateid
+		self.handle_message(mover, move, expected_replies=5)
+		self.assertLastMessageEquals(mover, f'{reason}. The game is a draw')
+		self.assertLastMessageEquals(opponent, f'{namemap[mover]} played {move}', target_index=-2)
+		self.assertLastMessageEquals(opponent, f'{reason}. The game is a draw')
+
+		with self.db.cursor() as cur:
+			cur.execute('SELECT active, outcome FROM games')
+			self.assertEqual(tuple(cur.fetchone()), (False, fbchessbot.DRAW))
+		_, _, game = self.db.get_context(nateid)
+		self.assertEqual(game, None)
+
+	def test_repetition(self):
+		self.perform_moves(nateid, jessid, [('Nf3', 'Nf6'), ('Ng1', 'Ng8'), ('Nf3', 'Nf6'), ('Ng1',)])
+		self.assertDrawn('Threefold repetition', jessid, 'Ng8')
+
+	def test_stalemate(self):
+		board = '''
+		k . . . . . . .
+		. . . . . . . .
+		. K . . . . . .
+		. . . . . . . .
+		. . . . . . . .
+		. . . . . . . .
+		. . . . . . . .
+		. . Q . . . . .
+		'''
+		self.set_position(board, ' w - - 0 1')
+		self.assertDrawn('Stalemate', nateid, 'Qc7')
 
 class TestMiscellaneous(GamePlayTest):
 	def test_show(self):
@@ -1270,6 +1305,479 @@ class SayTest(BaseTest):
 			self.handle_message(jessid, 'say ' + msg, expected_replies=2)
 			self.assertLastMessageEquals(chadid, 'Jess says\n' + msg.strip())
 
+class GameRoutesTest(BaseTest):
+	def setUp(self):
+		self.client = fbchessbot.app.test_client()
+		self.db.set_nickname(nateid, 'Nate')
+		self.db.set_nickname(chadid, 'Chad')
+		self.db.create_new_game(nateid, chadid)
+		self.gameid = self.db.get_most_recent_gameid(nateid)
+
+	def test_replay(self):
+		for url in [f'/replay/{self.gameid}', f'/replay/{self.gameid}.gif']:
+			with self.subTest(url):
+				response = self.client.get(url)
+				self.assertEqual(response.status_code, 200)
+				self.assertEqual(response.mimetype, 'image/gif')
+
+	def test_replay_missing_game(self):
+		for url in [f'/replay/{self.gameid + 1}', f'/replay/{self.gameid + 1}.gif', '/replay/nope']:
+			with self.subTest(url):
+				self.assertEqual(self.client.get(url).status_code, 404)
+
+	def test_pgn(self):
+		for url in [f'/pgn/{self.gameid}', f'/pgn/{self.gameid}.pgn']:
+			with self.subTest(url):
+				response = self.client.get(url)
+				self.assertEqual(response.status_code, 200)
+				self.assertIn('[Result "*"]', response.get_data(as_text=True))
+
+	def test_pgn_missing_game(self):
+		for url in [f'/pgn/{self.gameid + 1}.pgn', '/pgn/nope.pgn', f'/explore/{self.gameid + 1}']:
+			with self.subTest(url):
+				self.assertEqual(self.client.get(url).status_code, 404)
+
+class ConnectionPoolTest(unittest.TestCase):
+	def test_waits_then_gives_up(self):
+		pool = dbpool.ConnectionPool(dbactions.connect, minconn=0, maxconn=1, timeout=0.1)
+		with pool.connection():
+			with self.assertRaises(psycopg2.pool.PoolError):
+				pool.getconn()
+		stats = pool.stats()
+		self.assertEqual((stats['in_use'], stats['idle'], stats['timeouts']), (0, 1, 1))
+		pool.close()
+
+	def test_reconnects(self):
+		pool = dbpool.ConnectionPool(dbactions.connect, minconn=1, maxconn=2, check_after=0)
+		with pool.connection() as conn:
+			backend = conn.get_backend_pid()
+		other = dbactions.connect()
+		with other.cursor() as cur:
+			cur.execute('SELECT pg_terminate_backend(%s)', [backend])
+		other.close()
+		time.sleep(0.1)
+
+		with pool.connection() as conn, conn.cursor() as cur:
+			cur.execute('SELECT 1')
+			self.assertEqual(cur.fetchone()[0], 1)
+		self.assertEqual(pool.stats()['reconnects'], 1)
+		pool.close()
+
+class PreparedStatementTest(BaseTest):
+	def test_prepared_once(self):
+		self.db.set_nickname(nateid, 'Nate')
+		self.assertTrue(self.db.user_is_registered(nateid))
+		self.assertFalse(self.db.user_is_registered(chadid))
+		with self.db.cursor() as cur:
+			cur.execute("SELECT COUNT(*) FROM pg_prepared_statements WHERE name = 'user_is_registered'")
+			self.assertEqual(cur.fetchone()[0], 1)
+
+	def test_reprepared_when_gone(self):
+		self.db.set_nickname(nateid, 'Nate')
+		self.db.user_is_registered(nateid)
+		# As if a pooler had handed us a different session
+		with self.db.cursor() as cur:
+			cur.execute('DEALLOCATE ALL')
+		self.assertTrue(self.db.user_is_registered(nateid))
+
+	def test_already_prepared(self):
+		self.db.set_nickname(nateid, 'Nate')
+		self.db.user_is_registered(nateid)
+		# As if we'd lost track of what the session has
+		with self.db.cursor() as cur:
+			cur.connection.prepared.clear()
+		self.assertTrue(self.db.user_is_registered(nateid))
+
+	def test_stale_then_already_prepared(self):
+		self.db.set_nickname(nateid, 'Nate')
+		with self.db.cursor() as cur:
+			self.db.execute(cur, 'user_is_registered', [nateid])
+			# EXECUTE fails with 26000, and then DEALLOCATE ALL doesn't get rid of the statement
+			# (say, a pooler handed us a session that already has it), so PREPARE fails with 42P05
+			cur.execute('DEALLOCATE user_is_registered')
+			sql = dbactions.numbered_placeholders(dbactions.STATEMENTS['user_is_registered'])
+			statements = []
+			class Cursor:
+				connection = cur.connection
+				def execute(self, query, args=None):
+					statements.append(query)
+					if query == 'DEALLOCATE ALL':
+						query = f'PREPARE user_is_registered AS {sql}'
+					cur.execute(query, args)
+				def fetchone(self):
+					return cur.fetchone()
+			wrapped = Cursor()
+			self.db.execute(wrapped, 'user_is_registered', [nateid])
+			self.assertIsNotNone(wrapped.fetchone())
+			self.assertEqual([query.split()[0] for query in statements], ['EXECUTE', 'DEALLOCATE', 'PREPARE', 'EXECUTE'])
+
+class MessageLogTest(BaseTest):
+	def count_logged(self):
+		with self.db.cursor() as cur:
+			cur.execute('SELECT COUNT(*) FROM cb.message_log WHERE recipientid = %s', [nateid])
+			return cur.fetchone()[0]
+
+	def test_batches(self):
+		before = self.count_logged()
+		writer = messagelog.MessageLogWriter(self.db.log_messages, max_batch=4, flush_interval=0.2)
+		for i in range(10):
+			writer.log(f'message {i}', constants.MessageType.CHESSBOT_TEXT, recipientid=nateid)
+		writer.flush()
+		self.assertEqual(self.count_logged() - before, 10)
+		self.assertEqual(writer.stats()['batches'], 3)
+		writer.close()
+
+	def test_close_writes_the_rest(self):
+		before = self.count_logged()
+		writer = messagelog.MessageLogWriter(self.db.log_messages, flush_interval=10)
+		writer.log('goodbye', constants.MessageType.CHESSBOT_TEXT, recipientid=nateid)
+		writer.close()
+		self.assertEqual(self.count_logged() - before, 1)
+
+class BoardEncodingTest(unittest.TestCase):
+	def play(self, board, sans):
+		for san in sans:
+			board.push_san(san)
+		return board
+
+	def assertRoundTrips(self, board, version):
+		decoded = dbactions.ChessBoard.from_byte_string(board.to_byte_string(version))
+		self.assertEqual(decoded.move_stack, board.move_stack)
+		self.assertEqual(decoded.fen(), board.fen())
+
+	def test_round_trip(self):
+		# Castling, en passant and an underpromotion
+		board = self.play(dbactions.ChessBoard(), ['e4', 'd5', 'exd5', 'c5', 'dxc6', 'Nf6', 'cxb7', 'Bf5', 'bxa8=N', 'e6',
+			'Nf3', 'Be7', 'Bc4', 'O-O', 'O-O'])
+		for version in [1, 2]:
+			with self.subTest(version=version):
+				self.assertRoundTrips(board, version)
+
+	def test_960_castling(self):
+		board = self.play(dbactions.ChessBoard('qbbnrnkr/pppppppp/8/8/8/8/PPPPPPPP/QBBNRNKR w KQkq - 0 1'),
+			['Ng3', 'Ng6', 'O-O', 'O-O'])
+		for version in [1, 2]:
+			with self.subTest(version=version):
+				self.assertRoundTrips(board, version)
+
+	def test_old_format_still_decodes(self):
+		board = self.play(dbactions.ChessBoard(), ['e4', 'e5', 'Nf3'])
+		old = board.to_byte_string(1)
+		self.assertNotEqual(old[:1], dbactions.BOARD_FORMAT_V2)
+		self.assertEqual(dbactions.ChessBoard.from_byte_string(old).move_stack, board.move_stack)
+		self.assertEqual(board.to_byte_string()[:1], dbactions.BOARD_FORMAT_V2)
+
+class RenderCacheTest(unittest.TestCase):
+	def key(self, n):
+		return rendercache.board_key(f'position{n}', True)
+
+	def test_memory_eviction(self):
+		cache = rendercache.RenderCache(memory_budget=10)
+		cache.put(self.key(1), b'1111')
+		cache.put(self.key(2), b'2222')
+		cache.get(self.key(1))
+		# Over budget, so out goes the least recently used
+		cache.put(self.key(3), b'3333')
+		self.assertIn(self.key(1), cache)
+		self.assertNotIn(self.key(2), cache)
+		self.assertIn(self.key(3), cache)
+
+		# Too big to ever fit
+		cache.put(self.key(4), b'4' * 11)
+		self.assertNotIn(self.key(4), cache)
+
+		self.assertIsNone(cache.get(self.key(2)))
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+		self.assertEqual((stats['memory_entries'], stats['memory_bytes']), (2, 8))
+
+	def test_get_or_render(self):
+		cache = rendercache.RenderCache(memory_budget=100)
+		renders = []
+		def render():
+			renders.append(1)
+			return b'image'
+		first = cache.get_or_render(self.key(1), render)
+		second = cache.get_or_render(self.key(1), render)
+		self.assertEqual(len(renders), 1)
+		self.assertEqual(first.etag, second.etag)
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+	def test_disk_tier(self):
+		with tempfile.TemporaryDirectory() as directory:
+			cache = rendercache.RenderCache(memory_budget=4, disk_budget=10, directory=directory)
+			cache.put(self.key(1), b'1111')
+			cache.put(self.key(2), b'2222')
+			self.assertEqual(cache.stats()['memory_entries'], 1)
+
+			# Read back from disk, and back into memory, still dated when it was written
+			path = os.path.join(directory, f'{rendercache.key_digest(self.key(1))}.png')
+			os.utime(path, (1500000000, 1500000000))
+			entry = cache.get(self.key(1))
+			self.assertEqual(entry.data, b'1111')
+			self.assertEqual(entry.last_modified, datetime.datetime.utcfromtimestamp(1500000000))
+			self.assertEqual(cache.stats()['disk_hits'], 1)
+			self.assertEqual(cache.memory.get(self.key(1)).data, b'1111')
+
+			# 2 is now the least recently used on disk
+			cache.put(self.key(3), b'3333')
+			self.assertEqual(sorted(os.listdir(directory)),
+				sorted(f'{rendercache.key_digest(self.key(n))}.png' for n in [1, 3]))
+			stats = cache.stats()
+			self.assertEqual((stats['disk_entries'], stats['disk_bytes']), (2, 8))
+
+			# A new process picks up what's already there
+			cache = rendercache.RenderCache(memory_budget=4, disk_budget=10, directory=directory)
+			self.assertEqual(cache.get(self.key(3)).data, b'3333')
+			self.assertIsNone(cache.get(self.key(2)))
+			stats = cache.stats()
+			self.assertEqual((stats['hits'], stats['disk_hits'], stats['misses']), (1, 1, 1))
+
+	def test_not_modified(self):
+		client = fbchessbot.app.test_client()
+		url = '/board/rnbqkbnr-pppppppp-8-8-4P3-8-PPPP1PPP-RNBQKBNR?format=png'
+		response = client.get(url)
+		self.assertEqual(response.status_code, 200)
+		etag = response.headers['ETag']
+
+		response = client.get(url, headers={'If-None-Match': etag})
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.data, b'')
+
+		response = client.get(url.replace('4P3', '3P4'), headers={'If-None-Match': etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response.headers['ETag'], etag)
+
+class BoardRendererTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.renderer = drawing.BoardRenderer()
+
+	def placements(self, fen, sans):
+		board = chess.Board(fen)
+		placements = [board.board_fen()]
+		for san in sans:
+			board.push_san(san)
+			placements.append(board.board_fen())
+		return placements
+
+	def assertSameImage(self, image, expected):
+		self.assertEqual(image.mode, expected.mode)
+		self.assertEqual(image.getpalette(), expected.getpalette())
+		self.assertEqual(image.tobytes(), expected.tobytes())
+
+	def test_repaint_matches_full(self):
+		for name, fen, sans in [
+				('plain move', chess.STARTING_FEN, ['e4']),
+				('castling', 'r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1', ['O-O', 'O-O-O']),
+				('en passant', chess.STARTING_FEN, ['e4', 'Nf6', 'e5', 'd5', 'exd6']),
+				('promotion', '1n5k/P1P5/8/8/8/8/8/K7 w - - 0 1', ['a8=Q', 'Kg7', 'cxb8=N']),
+			]:
+			placements = self.placements(fen, sans)
+			for iswhite in [True, False]:
+				for palette in [False, True]:
+					with self.subTest(name, iswhite=iswhite, palette=palette):
+						for parent, placement in zip(placements, placements[1:]):
+							self.renderer.render(parent, iswhite, palette=palette)
+							repainted = self.renderer.render_from(parent, placement, iswhite, palette)
+							self.assertIsNotNone(repainted)
+							self.assertSameImage(repainted, self.renderer.render_full(placement, iswhite, palette))
+
+	def test_sequence_matches_full(self):
+		renderer = drawing.BoardRenderer(square=32)
+		placements = self.placements(chess.STARTING_FEN, ['e4', 'd5', 'exd5', 'Nf6', 'Bb5+', 'c6', 'dxc6', 'Qd6', 'cxb7+'])
+		for iswhite in [True, False]:
+			for palette in [False, True]:
+				with self.subTest(iswhite=iswhite, palette=palette):
+					frames = list(renderer.render_sequence(placements, iswhite, palette))
+					self.assertEqual(len(frames), len(placements))
+					for frame, placement in zip(frames, placements):
+						self.assertSameImage(frame, renderer.render_full(placement, iswhite, palette))
+
+class MovePersistenceTest(BaseTest):
+	def setUp(self):
+		self.db.set_nickname(nateid, 'Nate')
+		self.db.set_nickname(chadid, 'Chad')
+		self.db.set_opponent_context(nateid, chadid)
+		self.db.create_new_game(nateid, chadid)
+
+	def get_game(self):
+		return self.db.get_context(nateid)[2]
+
+	def push(self, game, san):
+		playerid = nateid if game.board.turn == chess.WHITE else chadid
+		game.board.push_san(san)
+		self.assertTrue(self.db.apply_move(game, playerid))
+
+	def pop(self, game):
+		# Whoever is to move accepts the other player's undo request
+		playerid = nateid if game.board.turn == chess.WHITE else chadid
+		self.db.set_undo_flag(game, True)
+		game.board.pop()
+		self.assertTrue(self.db.pop_move(game, playerid))
+
+	def test_append_and_pop(self):
+		game = self.get_game()
+		self.push(game, 'e4')
+		self.push(game, 'e5')
+		self.assertEqual(self.get_game().board.fen(), game.board.fen())
+
+		self.pop(game)
+		stored = self.get_game()
+		self.assertEqual(stored.board.move_stack, game.board.move_stack)
+		self.assertFalse(stored.board.turn)
+
+	def test_old_format_is_converted(self):
+		game = self.get_game()
+		game.board.push_san('e4')
+		with self.db.cursor() as cur:
+			cur.execute('UPDATE games SET board = %s WHERE id = %s', [game.board.to_byte_string(1), game.id])
+
+		game = self.get_game()
+		self.push(game, 'e5')
+		with self.db.cursor() as cur:
+			cur.execute('SELECT board FROM games WHERE id = %s', [game.id])
+			self.assertEqual(bytes(cur.fetchone().board)[:1], dbactions.BOARD_FORMAT_V2)
+		self.assertEqual(self.get_game().board.fen(), game.board.fen())
+
+	def test_turn_without_decoding(self):
+		self.push(self.get_game(), 'e4')
+		game = self.get_game()
+		self.assertTrue(game.is_active_player(chadid))
+		self.assertFalse(game.is_active_color(constants.WHITE))
+		self.assertIsNone(game._board)
+		self.assertFalse(game.board.turn)
+
+	def test_history(self):
+		game = self.get_game()
+		self.push(game, 'e4')
+		self.push(game, 'e5')
+		history = self.db.game_history(game.id)
+		self.assertEqual([entry.san for entry in history], [None, 'e4', 'e5'])
+		self.assertEqual(history[-1].fen, game.board.fen())
+
+		# Same number of moves, different game
+		self.pop(game)
+		self.push(game, 'c5')
+		history = self.db.game_history(game.id)
+		self.assertEqual([entry.san for entry in history], [None, 'e4', 'c5'])
+		self.assertEqual([entry.ply for entry in history], [0, 1, 2])
+
+	def test_apply_move(self):
+		game = self.get_game()
+		self.db.set_undo_flag(game, True)
+		game.board.push_san('e4')
+		self.assertFalse(self.db.apply_move(game, chadid))
+		self.assertTrue(self.db.apply_move(game, nateid))
+		stored = self.get_game()
+		self.assertEqual(stored.board.fen(), game.board.fen())
+		self.assertFalse(stored.undo)
+
+		# A move made from a stale copy of the game doesn't go through
+		game.board.push_san('e5')
+		stored.board.push_san('c5')
+		self.assertTrue(self.db.apply_move(stored, chadid))
+		self.assertFalse(self.db.apply_move(game, chadid))
+		self.assertEqual(self.get_game().board.peek(), chess.Move.from_uci('c7c5'))
+
+	def test_pop_move(self):
+		for san in ['e4', 'e5']:
+			self.push(self.get_game(), san)
+		self.db.set_undo_flag(self.get_game(), True)
+		first, second = self.get_game(), self.get_game()
+		first.board.pop()
+		second.board.pop()
+		# Nate is to move, so it's his to accept
+		self.assertFalse(self.db.pop_move(first, chadid))
+		self.assertTrue(self.db.pop_move(first, nateid))
+		stored = self.get_game()
+		self.assertEqual(stored.board.fen(), first.board.fen())
+		self.assertFalse(stored.undo)
+
+		# The same undo accepted twice only takes back one move
+		self.assertFalse(self.db.pop_move(second, nateid))
+		self.assertEqual(self.get_game().board.fen(), first.board.fen())
+
+	def test_apply_move_ends_game(self):
+		for san, playerid in [('f3', nateid), ('e5', chadid), ('g4', nateid)]:
+			game = self.get_game()
+			game.board.push_san(san)
+			self.assertTrue(self.db.apply_move(game, playerid))
+		game = self.get_game()
+		game.board.push_san('Qh4')
+		self.assertTrue(self.db.apply_move(game, chadid, constants.BLACK_WINS))
+		self.assertIsNone(self.get_game())
+		self.assertEqual(self.db.board_from_id(game.id).fen(), game.board.fen())
+
+	def test_repetition(self):
+		for san in ['Nf3', 'Nf6', 'Ng1', 'Ng8'] * 2:
+			self.push(self.get_game(), san)
+		game = self.get_game()
+		self.assertEqual(game.repetitions(), 3)
+		self.assertEqual(game.draw_reason(), 'Threefold repetition')
+
+		self.pop(game)
+		self.assertEqual(self.get_game().repetitions(), 2)
+		self.assertIsNone(self.get_game().draw_reason())
+
+	def test_stalemate(self):
+		self.db.create_new_game(nateid, chadid, '7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')
+		self.assertEqual(self.get_game().draw_reason(), 'Stalemate')
+
+	def test_checkpoints(self):
+		# Knights out and back, so the game can go on as long as we like
+		moves = ['Nf3', 'Nf6', 'Ng1', 'Ng8'] * 9
+		full = dbactions.ChessBoard()
+		for san in moves[:34]:
+			self.push(self.get_game(), san)
+			full.push_san(san)
+
+		game = self.get_game()
+		self.assertEqual(game.board.base_ply, 32)
+		self.assertEqual(game.board.fen(), full.fen())
+		# The board only has two moves, but the stored hashes go all the way back
+		self.assertEqual(game.repetitions(), 9)
+
+		# Undoing back past a checkpoint
+		for _ in range(3):
+			game = self.get_game()
+			self.pop(game)
+			full.pop()
+		game = self.get_game()
+		self.assertEqual(game.board.base_ply, 16)
+		self.assertEqual(game.board.fen(), full.fen())
+
+		self.assertEqual(self.db.board_from_id(game.id).move_stack, full.move_stack)
+
+		# The checkpoint for ply 32 went with the moves it was after
+		history = dbactions.ChessBoard()
+		for san in moves[:16]:
+			history.push_san(san)
+		with self.db.cursor() as cur:
+			cur.execute('SELECT ply, fen FROM cb.game_checkpoint WHERE gameid = %s ORDER BY ply', [game.id])
+			self.assertEqual([tuple(row) for row in cur.fetchall()], [(16, history.fen())])
+
+	def test_bulk_reencode(self):
+		moves = ['Nf3', 'Nf6', 'Ng1', 'Ng8'] * 5
+		board = dbactions.ChessBoard()
+		for san in moves:
+			board.push_san(san)
+		gameid = self.get_game().id
+		with self.db.cursor() as cur:
+			cur.execute('UPDATE games SET board = %s, current_fen = NULL WHERE id = %s', [board.to_byte_string(1), gameid])
+			cur.execute('DELETE FROM cb.game_checkpoint WHERE gameid = %s', [gameid])
+
+		done, written = bulkboards.reencode_boards(processes=2, batch_size=1, state_file=None, report=lambda *args: None)
+		self.assertEqual((done, written), (1, 1))
+		with self.db.cursor() as cur:
+			cur.execute('SELECT board, current_fen FROM games WHERE id = %s', [gameid])
+			row = cur.fetchone()
+			self.assertEqual(bytes(row.board), board.to_byte_string())
+			self.assertEqual(row.current_fen, board.fen())
+			cur.execute('SELECT ply, fen FROM cb.game_checkpoint WHERE gameid = %s ORDER BY ply', [gameid])
+			self.assertEqual([tuple(row) for row in cur], board.checkpoints())
+
 if __name__ == '__main__':
 	unittest.main()
 